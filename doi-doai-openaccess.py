@@ -7,19 +7,64 @@ Requires Wikimedia Labs labsdb local access.
 
 Usage:
     doi-doai-openaccess.py --help
-    doi-doai-openaccess.py [--depositable] [--oadoi] [--dbcnf=DBCNF]
-    [--list=FILE | <dbname>] [--download] [--export]
+    doi-doai-openaccess.py [--depositable [--hedge]] [--oadoi] [--dbcnf=DBCNF]
+    [--list=FILE | --all-wikis | <dbname>...] [--db-workers=N]
+    [--download [--max-size=MB] [--download-workers=N]
+    [--host-concurrency=N] [--host-delay=SECONDS]] [--export] [--workers=N]
+    [--cache=FILE [--cache-ttl=DAYS] [--cache-negative-ttl=DAYS]]
+    [--delta=FILE] [--oadoi-snapshot=PATH] [--journal=FILE [--resume]]
+    [--metrics=FILE [--metrics-interval=SECONDS]]
 
 Options:
     --help           Prints this documentation.
     --depositable    Lists closed access DOIs which could be deposited.
+    --hedge          Start the Dissemin, DOAI and deposit checks of a DOI
+                     at the same time instead of one after the other.
     --download       Download the PDF from the OA URL retrieved from oaDOI.
+    --max-size=MB    Skip PDFs bigger than this [default: 200].
+    --download-workers=N
+                     How many PDFs to download at the same time [default: 8].
+    --host-concurrency=N
+                     How many PDFs to download at the same time from
+                     a single host [default: 2].
+    --host-delay=SECONDS
+                     Minimum interval between two requests to a single
+                     host [default: 1].
     --oadoi          Use the Unpaywall (oaDOI) API instead of DOAI.
+    --oadoi-snapshot=PATH
+                     Answer oaDOI lookups from this Unpaywall snapshot
+                     (gzipped JSONL) and use the API only for the DOIs
+                     missing from it. An index is built next to it the
+                     first time.
     --export         Write a CSV with the OA URLs to dois.csv or [list].csv.
+                     With several wikis, also write the wikis citing each
+                     DOI to dois-wikis.csv.
     --list=FILE      Reads the DOIs from a text file rather than the database.
+    --all-wikis      Search DOIs in all the open Wikipedias listed in meta_p.
+    --db-workers=N   How many wikis to query at the same time [default: 4].
     --dbcnf=DBCNF    The configuration file with credentials
                      [default: ~/.my.cnf]
-    <dbname>         The dbname of the wiki to search DOIs in
+    --workers=N      How many DOIs to resolve concurrently; the output
+                     keeps the input order [default: 1].
+    --cache=FILE     Keep the answers of DOAI, oaDOI and Dissemin in this
+                     SQLite file and reuse them on the next runs.
+    --cache-ttl=DAYS
+                     How long to reuse a positive answer [default: 30].
+    --cache-negative-ttl=DAYS
+                     How long to reuse a negative answer [default: 7].
+    --delta=FILE     Only process DOIs not resolved in the previous runs:
+                     keep the resolved and failed DOIs and the last
+                     external link ID read from each wiki in this SQLite
+                     file. The failed DOIs are tried again.
+    --journal=FILE   Append the outcome of each DOI to this file, and write
+                     the DOIs which failed to [journal].failed at the end.
+    --resume         Skip the DOIs which the journal records as done.
+    --metrics=FILE   Periodically write the request and database statistics
+                     to this file, in Prometheus text format if its name
+                     ends with .prom and as JSON otherwise.
+    --metrics-interval=SECONDS
+                     How often to write the metrics file [default: 60].
+    <dbname>         The dbname of the wikis to search DOIs in
                      [default: enwiki].
 
 Copyright waived (CC-0), Federico Leva, 2016–2017
@@ -28,10 +73,21 @@ Copyright waived (CC-0), Federico Leva, 2016–2017
 from __future__ import absolute_import, division, print_function, \
                        unicode_literals
 
+import collections
+import concurrent.futures
+import functools
+import gzip
+import hashlib
+import itertools
+import mmap
 import os
-import random
+import pickle
 import re
+import sqlite3
+import struct
 import sys
+import tempfile
+import threading
 import time
 from contextlib import contextmanager
 from codecs import open
@@ -39,6 +95,8 @@ try:
     import unicodecsv as csv
 except ImportError:
     import csv as csv
+import email.utils
+import json
 import docopt
 import requests
 import requests.exceptions
@@ -49,9 +107,48 @@ except ImportError:
     print('WARNING: No pymysql, cannot query the DB')
 
 if sys.version_info >= (3,):
-    from urllib.parse import unquote, quote_plus
+    from urllib.parse import unquote, quote, quote_plus, urlparse
+    import queue
 else:
-    from urllib import unquote, quote_plus
+    from urllib import unquote, quote, quote_plus
+    from urlparse import urlparse
+    import Queue as queue
+
+# Maximum number of requests in flight to each service with --workers
+SERVICE_CONCURRENCY = {
+    'doai': 4,
+    'oadoi': 8,
+    'dissemin': 4,
+    'fatcat': 4,
+}
+SLOTS = dict((service, threading.BoundedSemaphore(limit))
+             for service, limit in SERVICE_CONCURRENCY.items())
+
+# Maximum number of requests per second to each service
+SERVICE_RATE = {
+    'doai': 10,
+    'oadoi': 10,
+    'dissemin': 5,
+    'fatcat': 10,
+}
+
+# Rows read at a time from the unbuffered database cursors
+FETCH_BATCH = 10000
+
+# Patterns for normalize_doi: the DOI in a link, anchors, trailing punctuation
+DOI_RE = re.compile(r'10\.[^/\s]+/\S+')
+DOI_ANCHOR_RE = re.compile(r'#.*$')
+DOI_TRAILING_RE = re.compile(r'[.,;:!?\'"\]}]+$')
+
+# The fatcat release search index, DOIs looked up at a time in it and
+# the URLs found there for the DOIs which are waiting to be resolved
+FATCAT_SEARCH = 'https://search.fatcat.wiki/fatcat_release/_search'
+FATCAT_BATCH = 100
+FATCAT_URLS = {}
+
+# Bytes read at a time from PDF downloads, and the maximum size of a PDF
+DOWNLOAD_CHUNK = 64 * 1024
+MAX_PDF_SIZE = 200 * 1024 * 1024
 
 SESSION = requests.Session()
 SESSIONDOAI = requests.Session()
@@ -59,16 +156,766 @@ try:
     from requests.packages.urllib3.util.retry import Retry
     from requests.adapters import HTTPAdapter
     # Courtesy datashaman https://stackoverflow.com/a/35504626
+    # Only connection errors are retried here: the 429 and 5xx answers
+    # must reach service_request, which slows down the TokenBucket.
     __retries__ = Retry(total=5,
                         backoff_factor=2,
-                        status_forcelist=[500, 502, 503, 504])
-    SESSION.mount('https://', HTTPAdapter(max_retries=__retries__))
-    SESSION.mount('http://', HTTPAdapter(max_retries=__retries__))
+                        status=0,
+                        respect_retry_after_header=False)
+    __poolsize__ = max(SERVICE_CONCURRENCY.values())
+    SESSION.mount('https://', HTTPAdapter(max_retries=__retries__,
+                                          pool_maxsize=__poolsize__))
+    SESSION.mount('http://', HTTPAdapter(max_retries=__retries__,
+                                         pool_maxsize=__poolsize__))
+    SESSIONDOAI.mount('http://', HTTPAdapter(pool_maxsize=__poolsize__))
 except:
     # Our urllib3/requests is too old
     pass
 
 
+class TokenBucket(object):
+    """ Adaptive rate limiter for a service. Requests take a token from
+        a bucket refilled at {rate} tokens per second. When the service
+        answers 429 or 503, or cannot be reached, the rate is halved and
+        the bucket is blocked for the Retry-After time or an exponential
+        backoff; every success brings the rate back towards {max_rate}.
+    """
+
+    def __init__(self, max_rate, min_rate=0.1, max_backoff=300):
+        self.max_rate = float(max_rate)
+        self.min_rate = min_rate
+        self.max_backoff = max_backoff
+        self.rate = self.max_rate
+        self.tokens = 1.0
+        self.updated = time.time()
+        self.blocked_until = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Wait until a request can be made. """
+        while True:
+            with self.lock:
+                now = time.time()
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                else:
+                    self.tokens = min(max(self.rate, 1.0), self.tokens +
+                                      (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def penalize(self, retry_after=None):
+        """ Slow down after the service refused or failed a request. """
+        with self.lock:
+            if time.time() >= self.blocked_until:
+                # A new overload episode: the failures of the requests
+                # which were in flight during a backoff do not compound it
+                self.failures += 1
+                self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after is None:
+                retry_after = min(self.max_backoff, 2 ** self.failures)
+            self.blocked_until = max(self.blocked_until,
+                                     time.time() + retry_after)
+            self.tokens = 0
+            self.updated = self.blocked_until
+
+    def reward(self):
+        """ Speed up again after a successful request. """
+        with self.lock:
+            self.failures = 0
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+
+RATES = dict((service, TokenBucket(rate))
+             for service, rate in SERVICE_RATE.items())
+
+
+class Stats(object):
+    """ Thread-safe counters of the requests made to each service (count,
+        latency histogram, status codes, retries, bytes) and of the time
+        spent running and fetching the database queries.
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.services = {}
+        self.queries = {}
+
+    def request(self, service, seconds, status, nbytes=0, retries=0):
+        """ Record a request; status is the HTTP status or an error name. """
+        with self.lock:
+            stats = self.services.setdefault(service, {
+                'requests': 0,
+                'seconds': 0.0,
+                'bytes': 0,
+                'retries': 0,
+                'statuses': collections.Counter(),
+                'histogram': [0] * len(self.BUCKETS),
+            })
+            stats['requests'] += 1
+            stats['seconds'] += seconds
+            stats['bytes'] += nbytes
+            stats['retries'] += retries
+            stats['statuses'][str(status)] += 1
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    stats['histogram'][i] += 1
+                    break
+
+    def query(self, name, query_seconds=0.0, fetch_seconds=0.0, rows=0):
+        """ Record the time spent on a database query. """
+        with self.lock:
+            stats = self.queries.setdefault(name, {
+                'query_seconds': 0.0,
+                'fetch_seconds': 0.0,
+                'rows': 0,
+            })
+            stats['query_seconds'] += query_seconds
+            stats['fetch_seconds'] += fetch_seconds
+            stats['rows'] += rows
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps({
+                'elapsed': time.time() - self.started,
+                'services': self.services,
+                'queries': self.queries,
+            }))
+
+    def prometheus(self):
+        """ The statistics in the Prometheus text exposition format. """
+        data = self.snapshot()
+        lines = []
+
+        def metric(name, kind, samples):
+            if kind:
+                lines.append(u'# TYPE doi_{} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append(u'doi_{}{{{}}} {}'.format(name, ','.join(
+                    u'{}="{}"'.format(k, v) for k, v in labels), value))
+
+        services = sorted(data['services'].items())
+        for key, name in (('requests', 'requests_total'),
+                          ('retries', 'retries_total'),
+                          ('bytes', 'response_bytes_total')):
+            metric(name, 'counter', [((('service', service),), stats[key])
+                                     for service, stats in services])
+        metric('responses_total', 'counter', [
+            ((('service', service), ('status', status)), count)
+            for service, stats in services
+            for status, count in sorted(stats['statuses'].items())])
+        histogram = []
+        for service, stats in services:
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, stats['histogram']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else bound
+                histogram.append(((('service', service), ('le', le)),
+                                  cumulative))
+        lines.append(u'# TYPE doi_request_duration_seconds histogram')
+        metric('request_duration_seconds_bucket', None, histogram)
+        metric('request_duration_seconds_sum', None,
+               [((('service', service),), stats['seconds'])
+                for service, stats in services])
+        metric('request_duration_seconds_count', None,
+               [((('service', service),), stats['requests'])
+                for service, stats in services])
+        queries = sorted(data['queries'].items())
+        for key in ('query_seconds', 'fetch_seconds', 'rows'):
+            metric('db_{}_total'.format(key), 'counter',
+                   [((('table', name),), stats[key])
+                    for name, stats in queries])
+        return u'\n'.join(lines) + u'\n'
+
+    def write(self, path):
+        """ Atomically replace path with the current statistics. """
+        if path.endswith('.prom'):
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=1, sort_keys=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as out:
+            out.write(content)
+        getattr(os, 'replace', os.rename)(path + '.tmp', path)
+
+    def report(self):
+        data = self.snapshot()
+        for service, stats in sorted(data['services'].items()):
+            print(u"{}: {} requests, {:.3f} s average, {} retries, {} bytes, "
+                  u"status codes: {}".format(
+                      service, stats['requests'],
+                      stats['seconds'] / stats['requests'], stats['retries'],
+                      stats['bytes'], ', '.join(
+                          u'{} {}'.format(status, count) for status, count
+                          in sorted(stats['statuses'].items()))),
+                  file=sys.stderr)
+        for name, stats in sorted(data['queries'].items()):
+            print(u"DB {}: {:.1f} s query, {:.1f} s fetch, {} rows".format(
+                name, stats['query_seconds'], stats['fetch_seconds'],
+                stats['rows']), file=sys.stderr)
+
+
+STATS = Stats()
+
+
+def write_metrics(path, interval):
+    """ Start a daemon thread writing STATS to path every interval. """
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                STATS.write(path)
+            except (IOError, OSError) as e:
+                print(u"WARNING: Could not write metrics: {}".format(e),
+                      file=sys.stderr)
+    thread = threading.Thread(target=loop)
+    thread.daemon = True
+    thread.start()
+
+
+def get_retry_after(response):
+    """ Seconds to wait according to the Retry-After header, if any. """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date:
+            return max(0, email.utils.mktime_tz(date) - time.time())
+    return None
+
+
+def service_request(service, method, url, session=None, retries=3, **kwargs):
+    """ Make a request to one of the OA services respecting its
+        TokenBucket in RATES. Requests answered with 429 or a 5xx error
+        are retried after the backoff, up to {retries} times.
+    """
+    bucket = RATES[service]
+    session = session or SESSION
+    if method == 'HEAD':
+        # Like Session.head(), we want to see the redirects
+        kwargs.setdefault('allow_redirects', False)
+    for attempt in range(retries + 1):
+        bucket.acquire()
+        start = time.time()
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            STATS.request(service, time.time() - start, type(e).__name__)
+            if isinstance(e, (requests.exceptions.ConnectionError,
+                              requests.exceptions.RetryError)):
+                bucket.penalize()
+            raise
+        # Retries made by urllib3 within this request, see __retries__
+        history = getattr(getattr(response.raw, 'retries', None),
+                          'history', None) or ()
+        STATS.request(service, time.time() - start, response.status_code,
+                      len(response.content), len(history) + (attempt > 0))
+        if response.status_code in (429, 500, 502, 503, 504):
+            bucket.penalize(get_retry_after(response))
+            continue
+        bucket.reward()
+        break
+    return response
+
+
+def report_rates():
+    for service in sorted(RATES):
+        print(u"Rate for {}: {:.2f} requests/s".format(service,
+                                                       RATES[service].rate),
+              file=sys.stderr)
+
+
+def throttled(service):
+    """ Decorator which limits the calls in flight to a service to
+        the number allowed by SERVICE_CONCURRENCY.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with SLOTS[service]:
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# The outcome of a DOI; if pending, it is reported later by the downloads
+Resolution = collections.namedtuple('Resolution', 'doi lines rows error pending')
+Resolution.__new__.__defaults__ = (False,)
+
+
+def map_ordered(func, iterable, workers=1):
+    """ Like map(), but runs func on up to {workers} threads at a time.
+        Results are yielded in the order of the input and only a bounded
+        window of items is pending, so iterable can be a long generator.
+    """
+    if workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class LookupCache(object):
+    """ SQLite cache of the answers of the OA services, keyed by service
+        and DOI. Negative answers (no URL, not depositable) can have a
+        shorter TTL than positive ones. Safe to share between threads.
+    """
+
+    def __init__(self, path, ttl, negative_ttl):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS lookups (
+            service TEXT NOT NULL,
+            doi TEXT NOT NULL,
+            result TEXT,
+            negative INTEGER NOT NULL,
+            checked REAL NOT NULL,
+            PRIMARY KEY (service, doi))""")
+
+    def get(self, service, doi):
+        """ Return (True, result) if a fresh answer is cached,
+            (False, None) otherwise.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT result, negative, checked FROM lookups '
+                'WHERE service = ? AND doi = ?', (service, doi)).fetchone()
+            if row:
+                ttl = self.negative_ttl if row[1] else self.ttl
+                if time.time() - row[2] < ttl:
+                    self.hits += 1
+                    result = json.loads(row[0])
+                    if isinstance(result, list):
+                        result = tuple(result)
+                    return True, result
+            self.misses += 1
+            return False, None
+
+    def set(self, service, doi, result):
+        if isinstance(result, (tuple, list)):
+            negative = not any(result)
+        else:
+            negative = not result
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?, ?)',
+                (service, doi, json.dumps(result), int(negative), time.time()))
+            self.pending += 1
+            if self.pending >= 100:
+                self.connection.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def report(self):
+        total = self.hits + self.misses
+        print(u"Cache hits: {} of {} lookups ({:.1%})"
+              .format(self.hits, total, self.hits / total if total else 0),
+              file=sys.stderr)
+
+
+CACHE = None
+
+
+def cached(service, error=False):
+    """ Decorator which answers from CACHE, when enabled, and stores there
+        the results of the call unless they are the {error} marker.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(doi):
+            if CACHE is None:
+                return func(doi)
+            found, result = CACHE.get(service, doi)
+            if found:
+                return result
+            result = func(doi)
+            if result is not error:
+                CACHE.set(service, doi, result)
+            return result
+        return wrapper
+    return decorator
+
+
+class DeltaState(object):
+    """ SQLite file remembering which DOIs were already resolved by a run,
+        which ones failed and the highest el_id read from each wiki, so
+        that the next run can query and process only what is new and
+        what has to be tried again. The marks are saved by close(), once
+        the DOIs read up to them were all resolved.
+    """
+
+    def __init__(self, path):
+        self.new = 0
+        self.old = 0
+        self.pending = 0
+        self.marks = {}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS seen '
+                                '(doi TEXT PRIMARY KEY) WITHOUT ROWID')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS retry '
+                                '(doi TEXT PRIMARY KEY) WITHOUT ROWID')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS marks '
+                                '(wiki TEXT PRIMARY KEY, el_id INTEGER)')
+
+    def get_mark(self, wiki):
+        """ Highest el_id read from the wiki in a completed scan. """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT el_id FROM marks WHERE wiki = ?', (wiki,)).fetchone()
+        return row[0] if row else 0
+
+    def set_mark(self, wiki, el_id):
+        """ Remember the highest el_id of a completed scan, to be saved
+            by close().
+        """
+        with self.lock:
+            self.marks[wiki] = el_id
+
+    def retries(self):
+        """ List of the DOIs whose resolution failed in a previous run. """
+        with self.lock:
+            return [row[0] for row in
+                    self.connection.execute('SELECT doi FROM retry')]
+
+    def unseen(self, dois):
+        """ Generator of the DOIs which were never resolved before,
+            each only once.
+        """
+        emitted = set([])
+        for doi in dois:
+            if doi in emitted:
+                continue
+            with self.lock:
+                row = self.connection.execute(
+                    'SELECT 1 FROM seen WHERE doi = ?', (doi,)).fetchone()
+                if row:
+                    self.old += 1
+                    continue
+                self.new += 1
+            emitted.add(doi)
+            yield doi
+
+    def record(self, doi, error=None):
+        """ Mark a DOI as seen once resolved, or keep it to be tried
+            again by the next run if its resolution failed.
+        """
+        with self.lock:
+            if error:
+                self.connection.execute(
+                    'INSERT OR IGNORE INTO retry VALUES (?)', (doi,))
+            else:
+                self.connection.execute(
+                    'INSERT OR IGNORE INTO seen VALUES (?)', (doi,))
+                self.connection.execute(
+                    'DELETE FROM retry WHERE doi = ?', (doi,))
+            self.pending += 1
+            if self.pending >= 1000:
+                self.connection.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO marks VALUES (?, ?)',
+                self.marks.items())
+            self.connection.commit()
+            self.connection.close()
+
+    def report(self):
+        print(u"Delta: {} new DOIs, {} already seen".format(self.new, self.old),
+              file=sys.stderr)
+
+
+class UnpaywallSnapshot(object):
+    """ Indexed local copy of an Unpaywall snapshot (gzipped JSONL).
+        Building the index writes the DOI and best_oa_location of every
+        record to {path}.dat, and a table of (DOI hash, offset in .dat)
+        pairs sorted by hash to {path}.idx. Lookups binary-search the
+        memory-mapped index, so they cost a few page reads.
+    """
+
+    ENTRY = struct.Struct('>QQ')
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path + '.idx') or \
+                os.path.getmtime(path + '.idx') < os.path.getmtime(path):
+            self.build()
+        self.files = [open(path + '.dat', 'rb'), open(path + '.idx', 'rb')]
+        self.data, self.index = [
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if os.fstat(f.fileno()).st_size else b''
+            for f in self.files]
+        self.count = len(self.index) // self.ENTRY.size
+
+    @staticmethod
+    def hash(doi):
+        digest = hashlib.md5(doi.lower().encode('utf-8')).digest()
+        return struct.unpack('>Q', digest[:8])[0]
+
+    def build(self):
+        """ Write the .dat and .idx files from the snapshot. Entries are
+            first spread over 256 temporary bucket files by the top byte
+            of their hash, so that each bucket can be sorted in memory.
+        """
+        print(u"INFO: Indexing the Unpaywall snapshot {}".format(self.path),
+              file=sys.stderr)
+        buckets = [open('{}.idx.{:d}'.format(self.path, i), 'wb')
+                   for i in range(256)]
+        with gzip.open(self.path, 'rb') as snapshot, \
+                open(self.path + '.dat.tmp', 'wb') as data:
+            offset = 0
+            for line in snapshot:
+                record = json.loads(line.decode('utf-8'))
+                doi = record.get('doi')
+                if not doi:
+                    continue
+                entry = u'{}\t{}\n'.format(
+                    doi.lower(), json.dumps(record.get('best_oa_location'))
+                ).encode('utf-8')
+                key = self.hash(doi)
+                buckets[key >> 56].write(self.ENTRY.pack(key, offset))
+                data.write(entry)
+                offset += len(entry)
+
+        with open(self.path + '.idx.tmp', 'wb') as index:
+            for i, bucket in enumerate(buckets):
+                bucket.close()
+                with open(bucket.name, 'rb') as f:
+                    raw = f.read()
+                entries = sorted(self.ENTRY.unpack_from(raw, pos)
+                                 for pos in range(0, len(raw),
+                                                  self.ENTRY.size))
+                for entry in entries:
+                    index.write(self.ENTRY.pack(*entry))
+                os.remove(bucket.name)
+        replace = getattr(os, 'replace', os.rename)
+        replace(self.path + '.dat.tmp', self.path + '.dat')
+        replace(self.path + '.idx.tmp', self.path + '.idx')
+
+    def lookup(self, doi):
+        """ Return (True, best_oa_location) if the DOI is in the snapshot,
+            (False, None) otherwise.
+        """
+        doi = doi.lower()
+        key = self.hash(doi)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.ENTRY.unpack_from(self.index,
+                                      middle * self.ENTRY.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        while low < self.count:
+            found, offset = self.ENTRY.unpack_from(self.index,
+                                                   low * self.ENTRY.size)
+            if found != key:
+                break
+            end = self.data.find(b'\n', offset)
+            line = self.data[offset:end].decode('utf-8')
+            entry_doi, location = line.split('\t', 1)
+            if entry_doi == doi:
+                return True, json.loads(location)
+            low += 1
+        return False, None
+
+
+SNAPSHOT = None
+
+
+class DownloadScheduler(object):
+    """ Pool of threads downloading PDFs, which fetches from different
+        hosts in parallel but keeps at most {per_host} downloads and one
+        request start every {delay} seconds for each host. A slow host
+        only holds its own slots, while the other hosts keep going.
+        Once all the URLs of a DOI were tried, callback(doi, error) is
+        called with error None if the PDF was saved.
+    """
+
+    def __init__(self, workers=8, per_host=2, delay=1.0, max_pending=1000,
+                 callback=None):
+        self.callback = callback
+        self.per_host = per_host
+        self.delay = delay
+        self.max_pending = max_pending
+        self.pending = 0
+        self.closed = False
+        self.queues = collections.OrderedDict()
+        self.active = collections.Counter()
+        self.ready_at = {}
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self.work)
+                        for _ in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, doi, urls):
+        """ Queue the download of a DOI from the first of the urls which
+            works; blocks while too many downloads are pending.
+        """
+        urls = list(urls)
+        if not urls:
+            return
+        with self.condition:
+            while self.pending >= self.max_pending:
+                self.condition.wait()
+            self.pending += 1
+            self.enqueue(doi, urls)
+
+    def enqueue(self, doi, urls):
+        host = urlparse(urls[0]).netloc
+        self.queues.setdefault(host, collections.deque()).append((doi, urls))
+        self.condition.notify_all()
+
+    def next_job(self):
+        """ Wait for a job whose host is free and return it with its host,
+            or None once closed and drained.
+        """
+        with self.condition:
+            while True:
+                now = time.time()
+                wait = None
+                for host, jobs in self.queues.items():
+                    if self.active[host] >= self.per_host:
+                        continue
+                    ready_at = self.ready_at.get(host, 0)
+                    if ready_at > now:
+                        wait = min(wait or ready_at - now, ready_at - now)
+                        continue
+                    job = jobs.popleft()
+                    if not jobs:
+                        del self.queues[host]
+                    self.active[host] += 1
+                    self.ready_at[host] = now + self.delay
+                    return host, job
+                if self.closed and not self.pending:
+                    return None
+                self.condition.wait(wait)
+
+    def work(self):
+        while True:
+            task = self.next_job()
+            if task is None:
+                return
+            host, (doi, urls) = task
+            saved = False
+            error = u'Download failed'
+            try:
+                saved = get_doi_download(doi, urls[0])
+            except Exception as e:
+                print(u"ERROR: Download failed for DOI {}: {}".format(doi, e),
+                      file=sys.stderr)
+                error = repr(e)
+            finished = True
+            with self.condition:
+                self.active[host] -= 1
+                if not saved and len(urls) > 1:
+                    self.enqueue(doi, urls[1:])
+                    finished = False
+                else:
+                    self.pending -= 1
+                self.condition.notify_all()
+            if finished and self.callback:
+                self.callback(doi, None if saved else error)
+
+    def close(self):
+        """ Wait for all the queued downloads to finish. """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+
+class Journal(object):
+    """ Append-only log of the outcome of each DOI, one "DOI<tab>status"
+        line per DOI where status is "done" or "failed: <error>".
+        Reading it back tells which DOIs a resumed run can skip.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set([])
+        self.failed = set([])
+        self.unsynced = 0
+        self.lock = threading.Lock()
+        truncated = False
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as journal:
+                for line in journal:
+                    # The last line can be truncated by a crash
+                    truncated = not line.endswith('\n')
+                    if truncated or '\t' not in line:
+                        continue
+                    doi, status = line.rstrip('\n').split('\t', 1)
+                    self.update(doi, status == 'done')
+        self.out = open(path, 'a', encoding='utf-8')
+        if truncated:
+            self.out.write(u'\n')
+
+    def update(self, doi, done):
+        if done:
+            self.done.add(doi)
+            self.failed.discard(doi)
+        else:
+            self.failed.add(doi)
+            self.done.discard(doi)
+
+    def record(self, doi, error=None):
+        status = u'failed: {}'.format(error) if error else u'done'
+        with self.lock:
+            self.out.write(u'{}\t{}\n'.format(doi,
+                                               status.replace('\n', ' ')))
+            self.out.flush()
+            self.unsynced += 1
+            if self.unsynced >= 1000:
+                os.fsync(self.out.fileno())
+                self.unsynced = 0
+            self.update(doi, not error)
+
+    def close(self):
+        self.out.close()
+        with open(self.path + '.failed', 'w', encoding='utf-8') as out:
+            for doi in sorted(self.failed):
+                out.write(u'{}\n'.format(doi))
+        print(u"Journal: {} DOIs done, {} failed (listed in {}.failed)"
+              .format(len(self.done), len(self.failed), self.path),
+              file=sys.stderr)
+
+
 @contextmanager
 def get_connection(wiki, dbcnf):
     """ Create a connection object to a database:
@@ -107,19 +954,48 @@ def main(argv=None):
     """ Queries the Wikimedia projects database replica on labsdb to list all
         links to DOI documents which are Open Access on DOAI and Dissem.in.
     """
+    global CACHE, MAX_PDF_SIZE, SNAPSHOT
+    delta = None
+    journal = None
     args = docopt.docopt(__doc__, argv=argv)
 
     # default does not seem to work properly
-    if args['<dbname>'] is None:
-        args['<dbname>'] = 'enwiki'
+    if not args['<dbname>']:
+        args['<dbname>'] = ['enwiki']
 
-    wiki = args['<dbname>']
+    wikis = args['<dbname>']
     dbcnf = os.path.abspath(os.path.expanduser(args['--dbcnf']))
+    citing = {}
+    counts = collections.Counter()
+    MAX_PDF_SIZE = int(float(args['--max-size']) * 1024 * 1024)
+
+    if args['--cache']:
+        CACHE = LookupCache(args['--cache'],
+                            float(args['--cache-ttl']) * 86400,
+                            float(args['--cache-negative-ttl']) * 86400)
+
+    if args['--delta']:
+        delta = DeltaState(args['--delta'])
+
+    if args['--journal']:
+        journal = Journal(args['--journal'])
+
+    if args['--metrics']:
+        write_metrics(args['--metrics'], float(args['--metrics-interval']))
+
+    if args['--oadoi-snapshot']:
+        SNAPSHOT = UnpaywallSnapshot(args['--oadoi-snapshot'])
+
+    if args['--all-wikis']:
+        wikis = get_wikis(dbcnf)
 
     if args['--list']:
         doilist = open(args['--list'], 'r', encoding='utf-8').readlines()
+    elif len(wikis) == 1:
+        doilist = get_doi_db(wikis[0], dbcnf, delta, counts)
     else:
-        doilist = get_doi_el(wiki, dbcnf).union(get_doi_iwl(wiki, dbcnf))
+        doilist = get_doi_wikis(wikis, dbcnf, delta,
+                                int(args['--db-workers']), citing, counts)
 
     if args['--export']:
         export = open((args['--list'] or 'dois') + '.csv', 'a')
@@ -128,119 +1004,444 @@ def main(argv=None):
                             lineterminator='\n')
         writer.writerow([u'DOI', u'best_oa_location', u'host_type'])
 
+    def finish(doi, error=None):
+        """ Record the outcome of a DOI in the journal and delta state. """
+        if journal:
+            journal.record(doi, error)
+        if delta:
+            delta.record(doi, error)
+
+    downloads = None
+    if args['--download'] and not args['--depositable']:
+        downloads = DownloadScheduler(int(args['--download-workers']),
+                                      int(args['--host-concurrency']),
+                                      float(args['--host-delay']),
+                                      callback=finish)
+
+    hedge = None
     if args['--depositable'] and not args['--oadoi']:
-        for doi in doilist:
-            doi = doi.strip()
-            try:
-                archived = get_dissemin_pdf(doi)
-                if archived:
-                    print(u"URL available for DOI: {}".format(doi))
-                else:
-                    archived = get_doai_oa(doi)
-                    if archived:
-                        if re.search('academia.edu', archived):
-                            print(u"Social URL available for DOI: {}"
-                                  .format(doi))
-                            archived = None
-                        else:
-                            print(u"URL available for DOI: http://doai.io/{}"
-                                  .format(doi))
-
-                if not archived and is_depositable(doi):
-                    print(u"Depositable DOI: {}".format(doi))
-                else:
-                    print(u"Non-depositable DOI: {}".format(doi))
-            except:
-                continue
+        if args['--hedge']:
+            hedge = concurrent.futures.ThreadPoolExecutor(
+                max_workers=3 * int(args['--workers']))
+        resolve = functools.partial(resolve_depositable, hedge=hedge)
     elif args['--depositable'] and args['--oadoi']:
-        for doi in doilist:
-            try:
-                doi = doi.strip()
-                if get_oadoi(doi):
-                    print(u"URL available in oaDOI for DOI: {}".format(doi))
-                else:
-                    if is_depositable(doi):
-                        print(u"Depositable DOI: {}".format(doi))
-                    else:
-                        print(u"Non-depositable DOI: {}".format(doi))
-            except:
-                continue
+        resolve = resolve_depositable_oadoi
     else:
-        for doi in doilist:
-            doi = doi.strip()
-            if args['--oadoi']:
-                pdf, host_type = get_oadoi(doi)
-                if pdf:
-                    print(doi)
-                    if args['--download']:
-                        get_doi_download(doi, pdf)
-                    if args['--export']:
-                        writer.writerow([doi, pdf, host_type])
-            else:
-                if args['--download']:
-                    get_doi_download_fatcat(doi)
-                else:
-                    get_doai_oa(doi)
-                    print(doi)
+        resolve = functools.partial(resolve_oa,
+                                    oadoi=args['--oadoi'],
+                                    downloads=downloads)
 
+    if args['--list']:
+        dois = unique_dois(doilist, counts)
+    else:
+        dois = doilist
+    if journal and args['--resume']:
+        dois = (doi for doi in dois if doi not in journal.done)
+    if delta:
+        dois = delta.unseen(itertools.chain(delta.retries(), dois))
+    if downloads and not args['--oadoi']:
+        dois = prefetch_fatcat(dois)
+    for result in map_ordered(resolve, dois, int(args['--workers'])):
+        for line in result.lines:
+            print(line)
         if args['--export']:
-            export.close()
+            for row in result.rows:
+                writer.writerow(row)
+        if not result.pending:
+            finish(result.doi, result.error)
+
+    if downloads:
+        downloads.close()
+    if hedge:
+        hedge.shutdown()
+    if args['--export']:
+        export.close()
+        if citing:
+            with open('dois-wikis.csv', 'w', encoding='utf-8') as out:
+                out.write(u'DOI\twikis\n')
+                for doi in sorted(citing):
+                    out.write(u'{}\t{}\n'.format(doi,
+                                                   ','.join(sorted(citing[doi]))))
+    print(u"DOIs: {} unique, {} duplicate lookups removed, {} invalid"
+          .format(counts['unique'], counts['duplicates'], counts['invalid']),
+          file=sys.stderr)
+    STATS.report()
+    report_rates()
+    if args['--metrics']:
+        STATS.write(args['--metrics'])
+    if CACHE:
+        CACHE.report()
+        CACHE.close()
+    if delta:
+        delta.report()
+        delta.close()
+    if journal:
+        journal.close()
+
+
+def resolve_depositable(doi, hedge=None):
+    """ Check whether a DOI is already archived (via Dissemin or DOAI) or
+        could be deposited. Return a Resolution with the lines to print.
+        With a hedge executor, the three checks are started at once and
+        the first conclusive answer, in the usual order of priority, is
+        used; the checks which are not needed anymore are cancelled.
+    """
+    checks = [get_dissemin_pdf, get_doai_oa, is_depositable]
+    if hedge:
+        futures = [hedge.submit(check, doi) for check in checks]
+        dissemin, doai, deposit = [future.result for future in futures]
+    else:
+        futures = []
+        dissemin, doai, deposit = [functools.partial(check, doi)
+                                   for check in checks]
+    lines = []
+    error = None
+    try:
+        archived = dissemin()
+        if archived:
+            lines.append(u"URL available for DOI: {}".format(doi))
+        else:
+            if archived is False:
+                error = u'Dissemin lookup failed'
+            archived = doai()
+            if archived is False:
+                error = u'DOAI lookup failed'
+            if archived:
+                if re.search('academia.edu', archived):
+                    lines.append(u"Social URL available for DOI: {}"
+                                 .format(doi))
+                    archived = None
+                else:
+                    lines.append(u"URL available for DOI: http://doai.io/{}"
+                                 .format(doi))
 
+        depositable = not archived and deposit()
+        if depositable is None:
+            error = error or u'Dissemin query failed'
+        if depositable:
+            lines.append(u"Depositable DOI: {}".format(doi))
+        else:
+            lines.append(u"Non-depositable DOI: {}".format(doi))
+        if archived:
+            # An archived copy was found: the failed lookups did not
+            # matter for the answer, unlike for a depositable one
+            error = None
+    except Exception as e:
+        error = repr(e)
+    finally:
+        for future in futures:
+            future.cancel()
+    return Resolution(doi, lines, [], error)
 
-def get_doi_el(wiki, dbcnf):
-    """ Set of DOI codes from external links. """
 
-    dois = set([])
+def resolve_depositable_oadoi(doi):
+    """ Check whether a DOI is open access in oaDOI or could be deposited.
+        Return a Resolution with the lines to print.
+    """
+    lines = []
+    error = None
+    try:
+        result = get_oadoi(doi)
+        if result is False:
+            error = u'oaDOI lookup failed'
+        if result and result[0]:
+            lines.append(u"URL available in oaDOI for DOI: {}".format(doi))
+        else:
+            depositable = is_depositable(doi)
+            if depositable is None:
+                error = error or u'Dissemin query failed'
+            if depositable:
+                lines.append(u"Depositable DOI: {}".format(doi))
+            else:
+                lines.append(u"Non-depositable DOI: {}".format(doi))
+    except Exception as e:
+        error = repr(e)
+    return Resolution(doi, lines, [], error)
 
-    doiquery = """SELECT el_to
-    FROM externallinks
-    WHERE el_index LIKE 'https://org.doi.dx./10%'
-    OR el_index LIKE 'http://org.doi.dx./10%'"""
 
-    with get_connection(wiki, dbcnf) as connection:
+def resolve_oa(doi, oadoi=False, downloads=None):
+    """ Look up the OA URL of a DOI and optionally queue the download of
+        the PDF to a DownloadScheduler. Return a Resolution with the lines
+        to print and the CSV rows, pending if a download was queued.
+    """
+    lines = []
+    rows = []
+    error = None
+    pending = False
+    try:
+        if oadoi:
+            result = get_oadoi(doi)
+            if result is False:
+                error = u'oaDOI lookup failed'
+            pdf, host_type = result or (None, None)
+            if pdf:
+                lines.append(doi)
+                rows.append([doi, pdf, host_type])
+                if downloads:
+                    downloads.submit(doi, [pdf])
+                    pending = True
+        else:
+            if downloads:
+                urls = get_fatcat_urls(doi)
+                if urls:
+                    lines.append(u"Found DOI: {} at URL: {}"
+                                 .format(doi, urls[0]))
+                    downloads.submit(doi, urls)
+                    pending = True
+            else:
+                if get_doai_oa(doi) is False:
+                    error = u'DOAI lookup failed'
+                lines.append(doi)
+    except Exception as e:
+        error = repr(e)
+    return Resolution(doi, lines, rows, error, pending)
+
+
+def normalize_doi(doi):
+    """ Canonical form of a DOI or of a link to it: URL-unescaped (also
+        when escaped twice), lowercase and without anchors and trailing
+        punctuation. Return None if no DOI is found.
+    """
+    if isinstance(doi, bytes):
+        doi = doi.decode('utf-8', 'replace')
+    # The anchor of the link, before an escaped # of the DOI is unquoted
+    doi = DOI_ANCHOR_RE.sub('', doi)
+    for _ in range(3):
+        unquoted = unquote(doi)
+        if unquoted == doi:
+            break
+        doi = unquoted
+    match = DOI_RE.search(doi)
+    if not match:
+        return None
+    doi = DOI_TRAILING_RE.sub('', match.group(0))
+    # Keep the closing parentheses which are part of the DOI, like in
+    # 10.1002/(SICI)1097-4571(199806)49:8<693::AID-ASI4>3.0.CO;2-O
+    while doi.endswith(')') and doi.count(')') > doi.count('('):
+        doi = doi[:-1]
+    return doi.lower()
+
+
+def unique_dois(dois, counts=None):
+    """ Generator of the normalized DOIs from an iterable of DOIs or links,
+        each only once. Invalid and duplicate entries are skipped and
+        counted in the counts Counter, if given.
+    """
+    seen = set([])
+    if counts is None:
+        counts = collections.Counter()
+    for doi in dois:
+        doi = normalize_doi(doi)
+        if not doi:
+            counts['invalid'] += 1
+        elif doi in seen:
+            counts['duplicates'] += 1
+        else:
+            seen.add(doi)
+            counts['unique'] += 1
+            yield doi
+
+
+def get_wikis(dbcnf):
+    """ List of the dbnames of all the open Wikipedias, from meta_p. """
+
+    with get_connection('meta', dbcnf) as connection:
         cursor = connection.cursor()
-        cursor.execute(doiquery)
-        for link in cursor.fetchall():
-            try:
-                doi = re.findall('10.+$', link[0].decode('utf-8'))[0]
-                if doi:
-                    dois.add(unquote(doi))
-            except IndexError:
-                continue
+        cursor.execute("""SELECT dbname
+        FROM wiki
+        WHERE family = 'wikipedia'
+        AND is_closed = 0""")
+        return [row[0].decode('utf-8') if isinstance(row[0], bytes) else row[0]
+                for row in cursor.fetchall()]
 
-    # print "Found %d DOI external links on %s" % (len(dois), wiki)
-    return dois
+
+def get_doi_wikis(wikis, dbcnf, delta=None, workers=4, citing=None,
+                  counts=None):
+    """ Generator of the unique DOI codes linked from any of the wikis,
+        which are queried in parallel by up to {workers} connections.
+        If a citing dictionary is given, the set of wikis linking each
+        DOI is recorded into it.
+    """
+
+    found = queue.Queue(maxsize=FETCH_BATCH)
+    stop = threading.Event()
+    done = object()
+    lock = threading.Lock()
+    if counts is None:
+        counts = collections.Counter()
+
+    def harvest(wiki):
+        wikicounts = collections.Counter()
+        try:
+            if stop.is_set():
+                return
+            for doi in get_doi_db(wiki, dbcnf, delta, wikicounts):
+                while not stop.is_set():
+                    try:
+                        found.put((wiki, doi), timeout=1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+        except Exception as e:
+            print(u"WARNING: Could not read DOIs from {}: {}".format(wiki, e),
+                  file=sys.stderr)
+        finally:
+            with lock:
+                counts['invalid'] += wikicounts['invalid']
+                counts['duplicates'] += wikicounts['duplicates']
+            found.put((wiki, done))
+
+    seen = set([])
+    remaining = len(wikis)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for wiki in wikis:
+            pool.submit(harvest, wiki)
+        try:
+            while remaining:
+                wiki, doi = found.get()
+                if doi is done:
+                    remaining -= 1
+                    continue
+                if citing is not None:
+                    citing.setdefault(doi, set([])).add(wiki)
+                if doi in seen:
+                    with lock:
+                        counts['duplicates'] += 1
+                else:
+                    seen.add(doi)
+                    with lock:
+                        counts['unique'] += 1
+                    yield doi
+        finally:
+            stop.set()
+            # Unblock the harvesters waiting to report that they are done
+            while remaining:
+                if found.get()[1] is done:
+                    remaining -= 1
 
 
-def get_doi_iwl(wiki, dbcnf):
-    """ Set of DOI codes from interwiki links. """
+def get_doi_db(wiki, dbcnf, delta=None, counts=None):
+    """ Generator of the unique DOI codes linked from a wiki, normalized
+        by unique_dois. Both tables are read over one connection as the
+        rows arrive from the server.
+        With a DeltaState, only external links added since its mark are
+        read and the mark is moved forward once the scan is complete.
+    """
 
-    dois = set([])
+    mark = {'el_id': delta.get_mark(wiki) if delta else 0}
+    with get_connection(wiki, dbcnf) as connection:
+        links = itertools.chain(get_doi_el(connection, mark),
+                                get_doi_iwl(connection))
+        for doi in unique_dois(links, counts):
+            yield doi
+    if delta:
+        delta.set_mark(wiki, mark['el_id'])
+
+
+def fetch_streaming(connection, query, name='query'):
+    """ Run a query with an unbuffered (server-side) cursor and yield
+        its rows. A reader thread drains the cursor at server speed into
+        a temporary spool file, in batches of FETCH_BATCH, so that the
+        slow consumption of the rows cannot make the server drop the
+        connection, while client memory stays flat.
+        The time spent is recorded in STATS under name.
+    """
+
+    spool = tempfile.TemporaryFile()
+    lock = threading.Lock()
+    batches = queue.Queue()
+
+    def read():
+        cursor = connection.cursor(dbclient.cursors.SSCursor)
+        try:
+            start = time.time()
+            cursor.execute(query)
+            STATS.query(name, query_seconds=time.time() - start)
+            while True:
+                start = time.time()
+                rows = cursor.fetchmany(FETCH_BATCH)
+                STATS.query(name, fetch_seconds=time.time() - start,
+                            rows=len(rows))
+                if not rows:
+                    break
+                with lock:
+                    spool.seek(0, os.SEEK_END)
+                    pickle.dump(rows, spool, pickle.HIGHEST_PROTOCOL)
+                    spool.flush()
+                batches.put(True)
+            cursor.close()
+            batches.put(None)
+        except Exception as e:
+            batches.put(e)
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    position = 0
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            with lock:
+                spool.seek(position)
+                rows = pickle.load(spool)
+                position = spool.tell()
+            for row in rows:
+                yield row
+    finally:
+        # The connection is only free for the next query once read
+        reader.join()
+        spool.close()
+
+
+def get_doi_el(connection, mark=None):
+    """ Generator of the targets of external links to DOIs, to be
+        normalized by normalize_doi. If a mark dictionary
+        is given, only links with el_id above mark['el_id'] are read and
+        the highest el_id seen is stored back into it.
+    """
+
+    since = mark['el_id'] if mark else 0
+    doiquery = """SELECT el_id, el_to
+    FROM externallinks
+    WHERE (el_index LIKE 'https://org.doi.dx./10%'
+    OR el_index LIKE 'http://org.doi.dx./10%')
+    AND el_id > {:d}""".format(since)
+
+    for link in fetch_streaming(connection, doiquery, 'externallinks'):
+        if mark is not None and link[0] > mark['el_id']:
+            mark['el_id'] = link[0]
+        yield link[1]
+
+
+def get_doi_iwl(connection):
+    """ Generator of DOI codes from interwiki links. """
 
     doiquery = """SELECT iwl_title
     FROM iwlinks
     WHERE iwl_prefix = 'doi'
     AND iwl_title LIKE '10%'"""
 
-    with get_connection(wiki, dbcnf) as connection:
-        cursor = connection.cursor()
-        cursor.execute(doiquery)
-        for link in cursor.fetchall():
-            dois.add(link[0])
-
-    return dois
+    for link in fetch_streaming(connection, doiquery, 'iwlinks'):
+        yield link[0]
 
 
+@cached('doai')
+@throttled('doai')
 def get_doai_oa(doi):
     """ Given a DOI, return DOAI target URL if green open access,
-        None otherwise.
+        None otherwise and False on errors.
     """
 
-    doaiurl = 'http://doai.io/{}'.format(doi)
+    doaiurl = 'http://doai.io/{}'.format(quote(doi, safe='/'))
     try:
-        doai = SESSIONDOAI.head(url=doaiurl)
+        doai = service_request('doai', 'HEAD', doaiurl, session=SESSIONDOAI)
     except requests.ConnectionError:
-        time.sleep(random.randint(1, 100))
         return False
 
     if doai.status_code == 302:
@@ -249,21 +1450,24 @@ def get_doai_oa(doi):
             return None
         else:
             return url
+    if doai.status_code == 404:
+        return None
+    # Overload (429, 5xx) or an unexpected answer: not a negative to cache
+    return False
 
 
 def get_oadoi(doi):
     """ Given a DOI, return oaDOI target URL if open access,
-        None otherwise.
+        None otherwise. The Unpaywall snapshot is used if loaded.
     """
 
-    try:
-        oadoi = SESSIONDOAI.get("http://api.unpaywall.org/v2/{}"
-                                "?email=openaccess@wikimedia.it"
-                                .format(doi))
-        oadoi = oadoi.json()['best_oa_location']
-    except:
-        time.sleep(random.randint(1, 100))
-        return False
+    found = False
+    if SNAPSHOT:
+        found, oadoi = SNAPSHOT.lookup(doi)
+    if not found:
+        oadoi = get_oadoi_location(doi)
+        if oadoi is False:
+            return False
 
     if oadoi:
         if oadoi['url_for_pdf']:
@@ -274,35 +1478,148 @@ def get_oadoi(doi):
         return None, None
 
 
+@cached('unpaywall')
+@throttled('oadoi')
+def get_oadoi_location(doi):
+    """ Given a DOI, return the best_oa_location from the Unpaywall API,
+        None if Unpaywall does not know the DOI and False on errors.
+    """
+
+    try:
+        oadoi = service_request('oadoi', 'GET',
+                                "http://api.unpaywall.org/v2/{}"
+                                "?email=openaccess@wikimedia.it"
+                                .format(quote(doi, safe='/')),
+                                session=SESSIONDOAI)
+    except requests.exceptions.RequestException:
+        return False
+    if oadoi.status_code == 404:
+        return None
+    if oadoi.status_code >= 300:
+        # Overload (429, 5xx) or an unexpected answer: not a negative
+        return False
+    try:
+        return oadoi.json()['best_oa_location']
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+@cached('dissemin')
+@throttled('dissemin')
 def get_dissemin_pdf(doi):
     """ Given a DOI, return the first URL which Dissemin believes to provide
-        a PDF
+        a PDF, None if there is none and False on errors.
     """
 
     try:
-        req = SESSION.get('https://dissem.in/api/%s' % doi)
-        if req.status_code >= 400:
+        req = service_request('dissemin', 'GET',
+                              'https://dissem.in/api/%s' % quote(doi, safe='/'))
+        if req.status_code in (400, 404, 410):
             return None
+        if req.status_code >= 300:
+            # Overload (429, 5xx) or an unexpected answer: not a negative
+            return False
         for record in req.json()['paper']['records']:
             if 'pdf_url' in record:
                 return record['pdf_url']
     except:
-        return
+        return False
 
     return
 
 
+def save_pdf(doi, url):
+    """ Stream the PDF at url into {doi}.pdf in the current directory.
+        The body goes to {doi}.pdf.part, which is moved into place only
+        once complete. The URL and the validator (ETag or Last-Modified)
+        of the partial file are kept in {doi}.pdf.part.json: if a previous
+        attempt at the same URL left it behind, it is resumed with a Range
+        and If-Range request. Return True if the PDF was saved, False
+        if the response is not a PDF or is bigger than MAX_PDF_SIZE.
+    """
+    path = "{}.pdf".format(quote_plus(doi))
+    part = path + '.part'
+    meta = part + '.json'
+    offset = 0
+    headers = {}
+    if os.path.exists(part):
+        try:
+            with open(meta, 'r', encoding='utf-8') as saved:
+                partial = json.load(saved)
+        except (IOError, OSError, ValueError):
+            partial = {}
+        if partial.get('url') == url:
+            offset = os.path.getsize(part)
+    if offset:
+        headers['Range'] = 'bytes={}-'.format(offset)
+        if partial.get('validator'):
+            headers['If-Range'] = partial['validator']
+
+    start = time.time()
+    size = offset
+    req = SESSION.get(url, timeout=10, stream=True, headers=headers)
+    try:
+        if req.status_code == 206 and offset:
+            mode = 'ab'
+            match = re.match(r'bytes (\d+)-',
+                             req.headers.get('Content-Range', ''))
+            if not match or int(match.group(1)) != offset:
+                # Not the continuation of our partial file
+                os.remove(part)
+                os.remove(meta)
+                return False
+        elif req.status_code == 200:
+            mode = 'wb'
+            offset = size = 0
+        else:
+            return False
+        if not req.headers.get('Content-Type', '').startswith('application/pdf'):
+            return False
+        length = int(req.headers.get('Content-Length') or 0)
+        if offset + length > MAX_PDF_SIZE:
+            return False
+
+        chunks = req.iter_content(chunk_size=DOWNLOAD_CHUNK)
+        first = next(chunks, b'')
+        if mode == 'wb' and not first.startswith(b'%PDF'):
+            return False
+        size = offset + len(first)
+        if mode == 'wb':
+            validator = req.headers.get('ETag')
+            if not validator or validator.startswith('W/'):
+                # Weak ETags cannot be used in If-Range
+                validator = req.headers.get('Last-Modified')
+            with open(meta, 'w', encoding='utf-8') as saved:
+                json.dump({'url': url, 'validator': validator}, saved)
+        with open(part, mode) as out:
+            out.write(first)
+            for chunk in chunks:
+                size += len(chunk)
+                if size > MAX_PDF_SIZE:
+                    break
+                out.write(chunk)
+        if size > MAX_PDF_SIZE:
+            os.remove(part)
+            os.remove(meta)
+            return False
+        getattr(os, 'replace', os.rename)(part, path)
+        os.remove(meta)
+        return True
+    finally:
+        req.close()
+        STATS.request('download', time.time() - start, req.status_code,
+                      max(0, size - offset))
+
+
 def get_doi_download(doi, url):
     """ Given an URL, download the PDF and save in current directory. """
     try:
-        with open("{}.pdf".format(quote_plus(doi)), 'wb') as out:
-            req = SESSION.get(url, timeout=10)
-            if req.status_code == 200 and req.headers['Content-Type'] == 'application/pdf':
-                out.write(req.content)
-            else:
-                return False
+        return save_pdf(doi, url)
     except requests.exceptions.ConnectionError:
         return None
+    except requests.exceptions.ChunkedEncodingError:
+        # The partial file is kept and resumed next time
+        return None
     except urllib3.exceptions.MaxRetryError:
         return False
     except requests.exceptions.RetryError:
@@ -311,41 +1628,102 @@ def get_doi_download(doi, url):
         # UnicodeDecodeError: 'utf-8' codec can't decode byte ...: invalid continuation byte
         return None
 
-def get_doi_download_fatcat(doi):
-    """ Given a DOI, download the PDF from fatcat and save in current directory. """
+def prefetch_fatcat(dois, size=None):
+    """ Pass through the DOIs, looking up the PDF URLs of each batch of
+        {size} DOIs in the fatcat search index beforehand, so that
+        get_fatcat_urls will not need any request for them.
+    """
+    size = size or FATCAT_BATCH
+    dois = iter(dois)
+    while True:
+        batch = list(itertools.islice(dois, size))
+        if not batch:
+            return
+        FATCAT_URLS.update(get_fatcat_urls_batch(batch))
+        for doi in batch:
+            yield doi
+
+
+@throttled('fatcat')
+def get_fatcat_urls_batch(dois):
+    """ Given a list of DOIs, return a dictionary with the web archive URLs
+        of the PDFs which the fatcat search index knows for them. Only
+        ia_pdf_url is used: best_pdf_url can be a publisher URL. The DOIs
+        without one are left out, so that get_fatcat_urls looks up their
+        repository copies one by one. Return an empty dictionary on errors.
+    """
+    query = {
+        'query': {'terms': {'doi': dois}},
+        'size': len(dois) * 4,
+        '_source': ['doi', 'ia_pdf_url'],
+    }
+    try:
+        req = service_request('fatcat', 'POST', FATCAT_SEARCH, json=query,
+                              timeout=10)
+        hits = req.json()['hits']['hits']
+    except (KeyError, ValueError, requests.exceptions.RequestException):
+        return {}
+
+    wanted = set(dois)
+    found = {}
+    for hit in hits:
+        release = hit['_source']
+        doi = (release.get('doi') or '').lower()
+        url = release.get('ia_pdf_url')
+        if doi not in wanted or not url:
+            continue
+        urls = found.setdefault(doi, [])
+        if url not in urls:
+            urls.append(url)
+    return found
+
+
+def get_fatcat_urls(doi):
+    """ Given a DOI, return the webarchive and repository URLs where fatcat
+        knows a PDF of it, from the results of prefetch_fatcat if any.
+    """
+    urls = FATCAT_URLS.pop(doi, None)
+    if urls is None:
+        urls = lookup_fatcat_urls(doi)
+    return urls
+
+
+@throttled('fatcat')
+def lookup_fatcat_urls(doi):
+    """ Given a DOI, look up in the fatcat API the webarchive and repository
+        URLs where fatcat knows a PDF of it.
+    """
+    urls = []
     try:
-        req = SESSION.head("https://fatcat.wiki/release/lookup?doi={}".format(doi), timeout=2)
+        req = service_request('fatcat', 'HEAD', "https://fatcat.wiki/release/lookup?doi={}".format(quote(doi, safe='/')), timeout=2)
         fatcatid = req.headers['Location'].split('/')[-1]
-        fatcat = SESSION.get("https://api.fatcat.wiki/v0/release/{}?expand=files".format(fatcatid), timeout=2)
+        fatcat = service_request('fatcat', 'GET', "https://api.fatcat.wiki/v0/release/{}?expand=files".format(fatcatid), timeout=2)
         for copy in fatcat.json()['files']:
             if copy['mimetype'] != "application/pdf":
                 continue
             for location in copy['urls']:
                 if location['rel'] == "webarchive" or location['rel'] == "repository":
-                    print("Found DOI: {} at URL: {}".format(doi, location['url']))
-                    pdf = SESSION.get(location['url'], timeout=10)
-                    if pdf.headers['Content-Type'] == 'application/pdf':
-                        out = open("{}.pdf".format(quote_plus(doi)), 'wb')
-                        out.write(pdf.content)
-                        out.close()
-                        return True
-        return None
+                    urls.append(location['url'])
     except KeyError:
-        return None
+        pass
     except requests.exceptions.ConnectionError:
-        return None
+        pass
     except urllib3.exceptions.MaxRetryError:
-        return False
+        pass
     except requests.exceptions.RetryError:
-        return False
+        pass
+    return urls
 
+@cached('depositable', error=None)
+@throttled('dissemin')
 def is_depositable(doi):
     # JSON requires 2.4.2
     # http://docs.python-requests.org/en/master/user/quickstart/#more-complicated-post-requests
-    payload = '{{ "doi": "{}" }}'.format(doi)
-    req = SESSION.post('https://dissem.in/api/query', data=payload)
+    payload = json.dumps({'doi': doi})
+    req = service_request('dissemin', 'POST',
+                          'https://dissem.in/api/query', data=payload)
     if req.status_code >= 400:
-        print(u"ERROR with: {}".format(doi))
+        # Reported as the error of the Resolution, not on the output
         return None
     try:
         dis = req.json()
@@ -12,20 +12,402 @@ import collections
 import concurrent.futures
 import csv
 import datetime
-from internetarchive import get_item, search_items, upload
+import gzip
+import hashlib
+import heapq
+from internetarchive import get_item, get_session, search_items, upload
 import json
 import os
 from pathlib import Path
 import re
 import requests
+import shutil
+import sqlite3
 import sys
-from time import sleep
+import threading
+from math import log
+from time import monotonic, sleep
 import zipfile
 try:
 	import nltk
 except ImportError:
 	print("WARNING: could not import nltk, cannot add subjects. Remember to also install data with: python3 -m nltk.downloader punkt snowball_data stopwords ")
 
+# How many pages of an issue to download at the same time
+PAGE_WORKERS = 4
+
+class RateBudget:
+	""" Token bucket limiting all the requests of the process to rate per second """
+
+	def __init__(self, rate):
+		self.rate = rate
+		self.tokens = 1.0
+		self.updated = monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		""" Sleep until a request can be made """
+		while True:
+			with self.lock:
+				now = monotonic()
+				self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1 - self.tokens) / self.rate
+			sleep(wait)
+
+# The global request budget for the download mode, if any
+BUDGET = None
+
+def spend():
+	""" Wait for the global request budget before making a request """
+	if BUDGET:
+		BUDGET.acquire()
+
+class Metrics:
+	"""
+	Thread-safe counters of the work done (pages, days, bytes), of the
+	requests and their latency, of the errors by type and of the requests
+	in flight, to be reported periodically by a Reporter.
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = monotonic()
+		self.progress = self.started
+		self.counters = collections.Counter()
+		self.errors = collections.Counter()
+		self.requests = 0
+		self.seconds = 0.0
+		self.slowest = 0.0
+		self.inflight = {}
+		self.next_token = 0
+
+	def start(self, label):
+		""" Record the start of a request and return a token for finish """
+		with self.lock:
+			self.next_token += 1
+			self.inflight[self.next_token] = (label, monotonic())
+			return self.next_token
+
+	def finish(self, token, nbytes=0, error=None):
+		""" Record the end of a request, with the bytes received or the type of error """
+		with self.lock:
+			label, started = self.inflight.pop(token)
+			seconds = monotonic() - started
+			self.requests += 1
+			self.seconds += seconds
+			self.slowest = max(self.slowest, seconds)
+			self.counters['bytes'] += nbytes
+			if error:
+				self.errors[error] += 1
+			else:
+				self.progress = monotonic()
+
+	def count(self, name, n=1):
+		""" Add n to the counter name, like pages or days, which counts as progress """
+		with self.lock:
+			self.counters[name] += n
+			self.progress = monotonic()
+
+	def error(self, kind):
+		with self.lock:
+			self.errors[kind] += 1
+
+	def snapshot(self):
+		with self.lock:
+			now = monotonic()
+			elapsed = max(now - self.started, 1e-9)
+			oldest = min(self.inflight.values(), key=lambda request: request[1], default=None)
+			data = {
+				'elapsed': elapsed,
+				'counters': dict(self.counters),
+				'rates': {name: value / elapsed for name, value in self.counters.items()},
+				'requests': self.requests,
+				'request_seconds': self.seconds,
+				'latency_average': self.seconds / self.requests if self.requests else 0.0,
+				'latency_max': self.slowest,
+				'errors': dict(self.errors),
+				'in_flight': len(self.inflight),
+				'oldest_in_flight': oldest[0] if oldest else None,
+				'oldest_in_flight_seconds': now - oldest[1] if oldest else 0.0,
+				'idle_seconds': now - self.progress,
+			}
+		return data
+
+	def status(self):
+		""" A one line summary of the snapshot """
+		data = self.snapshot()
+		rates = ", ".join("{:.2f} {}/s".format(rate, name) for name, rate in sorted(data['rates'].items()))
+		errors = ", ".join("{} {}".format(count, kind) for kind, count in sorted(data['errors'].items()))
+		return "STATUS {}: {} after {:.0f} s; {} requests, {:.2f} s average, {:.2f} s max; errors: {}; {} in flight, oldest {:.0f} s".format(
+			datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), rates or "nothing done", data['elapsed'], data['requests'], data['latency_average'], data['latency_max'],
+			errors or "none", data['in_flight'], data['oldest_in_flight_seconds'])
+
+	def prometheus(self):
+		""" The snapshot in the Prometheus text exposition format """
+		data = self.snapshot()
+		lines = []
+		for name, value in sorted(data['counters'].items()):
+			lines.append('# TYPE lastampa_{}_total counter'.format(name))
+			lines.append('lastampa_{}_total {}'.format(name, value))
+		lines.append('# TYPE lastampa_requests_total counter')
+		lines.append('lastampa_requests_total {}'.format(data['requests']))
+		lines.append('# TYPE lastampa_request_seconds_total counter')
+		lines.append('lastampa_request_seconds_total {}'.format(data['request_seconds']))
+		lines.append('# TYPE lastampa_errors_total counter')
+		for kind, count in sorted(data['errors'].items()):
+			lines.append('lastampa_errors_total{{type="{}"}} {}'.format(kind.replace('"', "'"), count))
+		for name in ('in_flight', 'oldest_in_flight_seconds', 'idle_seconds'):
+			lines.append('# TYPE lastampa_{} gauge'.format(name))
+			lines.append('lastampa_{} {}'.format(name, data[name]))
+		return "\n".join(lines) + "\n"
+
+	def save(self, path):
+		""" Write the metrics to path, in the Prometheus format if it ends with .prom, as JSON otherwise """
+		with open(path + '.tmp', 'w') as out:
+			if path.endswith('.prom'):
+				out.write(self.prometheus())
+			else:
+				json.dump(self.snapshot(), out)
+		os.replace(path + '.tmp', path)
+
+# The metrics of the current mode
+METRICS = Metrics()
+
+class Reporter(threading.Thread):
+	"""
+	Print the status line of the metrics every interval seconds and save them
+	to path, if given. With watchdog (in minutes), flag the lack of progress
+	and, if it lasts twice as long, close the open PageWriters and exit with
+	status 3 so that a wrapper can start the bot again (with --resume to keep
+	the pages already downloaded).
+	"""
+
+	def __init__(self, metrics, interval=60, path=None, watchdog=None):
+		super().__init__(daemon=True)
+		self.metrics = metrics
+		self.interval = interval
+		self.path = path
+		self.watchdog = watchdog * 60 if watchdog else None
+		self.stopped = threading.Event()
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			self.report()
+			if self.watchdog:
+				data = self.metrics.snapshot()
+				if data['idle_seconds'] > 2 * self.watchdog:
+					print("ERROR: No progress for {:.0f} minutes, exiting".format(data['idle_seconds'] / 60), flush=True)
+					# The stuck threads cannot be stopped, but the archives
+					# must be left readable for the restart
+					for writer in list(WRITERS):
+						writer.close()
+					self.report()
+					os._exit(3)
+				if data['idle_seconds'] > self.watchdog:
+					print("ERROR: No progress for {:.0f} minutes; {} requests in flight, the oldest for {:.0f} s: {}".format(
+						data['idle_seconds'] / 60, data['in_flight'], data['oldest_in_flight_seconds'], data['oldest_in_flight']), flush=True)
+
+	def report(self):
+		print(self.metrics.status(), flush=True)
+		if self.path:
+			self.metrics.save(self.path)
+
+	def stop(self):
+		""" Stop and make a last report """
+		self.stopped.set()
+		self.report()
+
+def fetch(s, url, label, **kwargs):
+	""" GET the url with s (a session or the requests module), recording the metrics """
+
+	token = METRICS.start(label)
+	try:
+		response = s.get(url, **kwargs)
+	except Exception as e:
+		METRICS.finish(token, error=type(e).__name__)
+		raise
+	METRICS.finish(token, len(response.content), None if response.status_code < 400 else 'HTTP {}'.format(response.status_code))
+	return response
+
+class Client:
+	"""
+	Long-lived client for archiviolastampa.it, shared by all threads: one
+	session with a pool of kept-alive connections, explicit timeouts and the
+	t token of the site, scraped once and refreshed only when rejected.
+	"""
+
+	def __init__(self, timeout=(10, 60), connections=32):
+		self.timeout = timeout
+		self.session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=connections)
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+		self.t = None
+		self.lock = threading.Lock()
+
+	def get(self, url, label):
+		""" GET the url under the global budget with the timeouts """
+		spend()
+		return fetch(self.session, url, label, timeout=self.timeout)
+
+	def token(self):
+		""" Return the t token, scraping it from the home page the first time """
+		with self.lock:
+			if self.t is None:
+				# We need the parameter from the hidden input
+				# <input type="hidden" name="t" value="a2016dedff5843c652d2fdf4f87055cc" />
+				home = self.get('http://www.archiviolastampa.it/', 'home')
+				self.t = re.findall('<input type="hidden" name="t" value="([a-z0-9]+)"', home.text)[0]
+			return self.t
+
+	def reject(self, t):
+		""" Forget the token t, rejected by the server, unless another thread already replaced it """
+		with self.lock:
+			if self.t == t:
+				print("INFO: The token was rejected, getting a new one")
+				self.t = None
+
+# The client for all the requests to archiviolastampa.it
+CLIENT = Client()
+
+class Pacer:
+	"""
+	Adaptive pacing for the requests to archiviolastampa.it, shared by threads.
+	Requests start at least delay seconds apart: the delay shrinks while the
+	server responds well and grows quickly on errors.
+	"""
+
+	def __init__(self, delay=1.0, minimum=0.1, maximum=30.0):
+		self.delay = delay
+		self.minimum = minimum
+		self.maximum = maximum
+		self.next_start = 0
+		self.lock = threading.Lock()
+
+	def wait(self):
+		""" Sleep until the next request can start """
+		with self.lock:
+			now = monotonic()
+			start = max(now, self.next_start)
+			self.next_start = start + self.delay
+		sleep(start - now)
+
+	def success(self):
+		with self.lock:
+			self.delay = max(self.minimum, self.delay * 0.8)
+
+	def failure(self):
+		with self.lock:
+			self.delay = min(self.maximum, max(1.0, self.delay * 2))
+
+# The PageWriters currently open, to be closed before a forced exit
+WRITERS = set()
+
+class PageWriter:
+	"""
+	Save the files of the pages of an issue, thread-safe. By default they are
+	loose files in the day directory; with archive=True they are streamed into
+	{identifier}_images.zip and {identifier}_pagedata.zip as they arrive.
+	Every file written is recorded with its size and SHA-1 in the manifest.json
+	of the day, so that an interrupted download can be resumed; finish() marks
+	the day as complete.
+	"""
+
+	def __init__(self, day_ymd, identifier, archive=False):
+		self.day_ymd = day_ymd
+		self.archives = {}
+		self.lock = threading.Lock()
+		self.manifest = readManifest(day_ymd)
+		self.closed = False
+		WRITERS.add(self)
+		if archive:
+			# JPEG does not compress any further
+			self.archives['.jpg'] = self.openArchive('{}/{}_images.zip'.format(day_ymd, identifier), zipfile.ZIP_STORED)
+			self.archives['.json'] = self.openArchive('{}/{}_pagedata.zip'.format(day_ymd, identifier), zipfile.ZIP_DEFLATED)
+
+	def openArchive(self, path, compression):
+		""" Open an archive to append to, starting it again if it was left unreadable """
+		try:
+			return zipfile.ZipFile(path, 'a', compression=compression)
+		except zipfile.BadZipFile:
+			print("WARNING: Archive {} is corrupt, downloading its files again".format(path))
+			with zipfile.ZipFile(path + '.tmp', 'w'):
+				pass
+			os.replace(path + '.tmp', path)
+			return zipfile.ZipFile(path, 'a', compression=compression)
+
+	def write(self, name, content):
+		""" Save content (bytes or text) as the file name """
+		if not isinstance(content, bytes):
+			content = content.encode('utf-8')
+		if self.archives:
+			with self.lock:
+				self.archives[os.path.splitext(name)[1]].writestr(name, content)
+				self.record(name, content)
+		else:
+			with open('{}/{}'.format(self.day_ymd, name), 'wb') as out:
+				out.write(content)
+			with self.lock:
+				self.record(name, content)
+
+	def record(self, name, content):
+		""" Add a file to the manifest and save it, with the lock held """
+		self.manifest['files'][name] = [len(content), hashlib.sha1(content).hexdigest()]
+		writeManifest(self.day_ymd, self.manifest)
+
+	def finish(self):
+		""" Mark the day as complete in the manifest, so that resuming skips it """
+		with self.lock:
+			self.manifest['complete'] = True
+			writeManifest(self.day_ymd, self.manifest)
+
+	def complete(self, name):
+		""" Whether the file name was written and still has the size and checksum in the manifest """
+		with self.lock:
+			if name not in self.manifest['files']:
+				return False
+			try:
+				if self.archives:
+					content = self.archives[os.path.splitext(name)[1]].read(name)
+				else:
+					with open('{}/{}'.format(self.day_ymd, name), 'rb') as stored:
+						content = stored.read()
+			except (KeyError, OSError, zipfile.BadZipFile):
+				return False
+			return [len(content), hashlib.sha1(content).hexdigest()] == self.manifest['files'][name]
+
+	def close(self):
+		with self.lock:
+			if self.closed:
+				return
+			self.closed = True
+			for archive in self.archives.values():
+				archive.close()
+		WRITERS.discard(self)
+
+def readManifest(day_ymd):
+	"""
+	Return the manifest of the files downloaded for a day: whether the day is
+	complete and the files, as name: [size, sha1]
+	"""
+
+	try:
+		with open('{}/manifest.json'.format(day_ymd), 'r') as j:
+			return json.load(j)
+	except (FileNotFoundError, json.decoder.JSONDecodeError):
+		return {'complete': False, 'files': {}}
+
+def writeManifest(day_ymd, manifest):
+	""" Replace the manifest of a day """
+
+	with open('{}/manifest.json.tmp'.format(day_ymd), 'w') as out:
+		json.dump(manifest, out)
+	os.replace('{}/manifest.json.tmp'.format(day_ymd), '{}/manifest.json'.format(day_ymd))
+
 def getDayId(day, headboard='01'):
 	"""
 	Get the magic ID of the day from the index of the next day.
@@ -34,18 +416,95 @@ def getDayId(day, headboard='01'):
 
 	next_day = (day + datetime.timedelta(days=1)).strftime('%Y-%m-%d')
 	url = "http://www.archiviolastampa.it/index2.php?option=com_lastampa&task=issue&no_html=1&type=neighbors&headboard={}&date={}%2000:00:00".format(headboard, next_day)
-	index = requests.get(url)
+	index = CLIENT.get(url, 'neighbors')
 
 	# Expected output is something like:
 	# {"previousIssueId":"1319_02_1989_0242_0001","nextIssueId":"1319_02_1989_0244_0001"} 
 	if index.status_code < 300:
 		return index.json()['previousIssueId']
 
+def getNextIssueId(day, headboard='01'):
+	"""
+	Get the ID of the first issue after the day (a date string) from the neighbors API,
+	None at the end of the chain. Raise on HTTP errors and on answers which are not JSON.
+	"""
+
+	url = "http://www.archiviolastampa.it/index2.php?option=com_lastampa&task=issue&no_html=1&type=neighbors&headboard={}&date={}%2000:00:00".format(headboard, day)
+	index = CLIENT.get(url, 'neighbors')
+	index.raise_for_status()
+	return index.json().get('nextIssueId')
+
+def buildIssueIndex(headboard='01', start='1867-02-09', end='2005-12-31', path=None):
+	"""
+	Walk the chain of nextIssueId from the start date and save date, identifier
+	and metadata of every real issue of the headboard to a TSV file. The file
+	is appended to as we go, so an interrupted walk continues from its last issue.
+	"""
+
+	path = path or 'issues-{}.tsv'.format(headboard)
+	day = (datetime.datetime.strptime(start, '%Y-%m-%d') - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+	identifier = None
+	if os.path.exists(path):
+		for row in readIssueIndex(path).values():
+			day = max(day, row[1]['data_uscita'][:10])
+			identifier = row[0]
+
+	with open(path, 'a') as out:
+		writer = csv.writer(out, delimiter='\t', lineterminator='\n')
+		while day < end:
+			for attempt in range(3):
+				try:
+					next_identifier = getNextIssueId(day, headboard)
+					break
+				except (requests.exceptions.RequestException, ValueError) as e:
+					print("WARNING: Could not get the issue after {}: {}".format(day, e))
+					sleep(10)
+			else:
+				print("ERROR: Could not get the issue after {}, run again to continue".format(day))
+				return False
+			if next_identifier == identifier:
+				# Not past the current issue yet, ask from the next day
+				day = (datetime.datetime.strptime(day, '%Y-%m-%d') + datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+				continue
+			if not next_identifier:
+				print("INFO: No issue after {}".format(day))
+				break
+			identifier = next_identifier
+			for attempt in range(3):
+				metadata = getIssueMetadata(identifier)
+				if metadata:
+					break
+				sleep(10)
+			else:
+				print("ERROR: Could not get metadata for {}, run again to continue from {}".format(identifier, day))
+				return False
+			if metadata['data_uscita'][:10] <= day:
+				print("ERROR: Issue {} is not after {}, stopping".format(identifier, day))
+				return False
+			day = metadata['data_uscita'][:10]
+			if day > end:
+				break
+			writer.writerow([metadata['data_uscita'], identifier, metadata.get('id_testata', headboard), metadata.get('uscita', ''), metadata.get('nome_testata', '')])
+			out.flush()
+			print("INFO: Found {} for {}".format(identifier, day))
+	return True
+
+def readIssueIndex(path):
+	""" Read an index made by buildIssueIndex, return an ordered dictionary of date: (identifier, metadata) """
+
+	issues = collections.OrderedDict()
+	with open(path, 'r') as index:
+		for row in csv.reader(index, delimiter='\t'):
+			if len(row) < 5:
+				continue
+			issues[row[0][:10]] = (row[1], {'data_uscita': row[0], 'id_testata': row[2], 'uscita': row[3], 'nome_testata': row[4]})
+	return issues
+
 def getIssueMetadata(identifier):
 	""" Issue metadata from the identifier """
 
 	url = "http://www.archiviolastampa.it/index2.php?option=com_lastampa&task=issue&no_html=1&type=info&issueid={}".format(identifier)
-	info = requests.get(url)
+	info = CLIENT.get(url, 'info')
 
 	# Expected output is something like:
 	# {"id_testata":"02","uscita":"243","data_uscita":"1989-09-13 00:00:00","nome_testata":"Europa"} 
@@ -78,6 +537,8 @@ def makeDay(day, metadata):
 		except FileExistsError:
 			print("INFO: Day {} was already done".format(day_ymd))
 			return False
+		# An empty manifest tells that the day can be resumed
+		writeManifest(day_ymd, readManifest(day_ymd))
 
 		# FIXME: Should use cross-platform path joining here and below.
 		with open('{}/issue_metadata.json'.format(day_ymd), 'w') as jsonout:
@@ -87,16 +548,30 @@ def makeDay(day, metadata):
 		# We got a different day, probably there's a gap for festivities.
 		return False
 
-def downloadDay(day, headboard='01'):
-	""" Retrieve data for issue, prepare files and download images """
+def downloadDay(day, headboard='01', archive=False, issue=None, resume=False):
+	"""
+	Retrieve data for issue, prepare files and download images, straight into
+	zip archives if archive is True. The identifier and metadata of the issue
+	are looked up unless given in issue, as read from the index. With resume,
+	a day directory which already exists is completed, downloading only the
+	files missing from its manifest or not matching it.
+	"""
 
 	day_ymd = day.strftime('%Y-%m-%d')
-	incomplete = None
-	identifier = getDayId(day, headboard)
-	# TODO: Add a timestamp so it's easier to spot stuck downloaders.
-	print("INFO: Found {} for {}".format(identifier, day.strftime('%Y-%m-%d')))
-	metadata = getIssueMetadata(identifier)
-	sleep(0.1)
+	resuming = resume and os.path.isdir(day_ymd)
+	pages_json = None
+	if resuming:
+		pages_json = next(Path(day_ymd).glob('*_pages.json'), None)
+	if pages_json:
+		identifier = pages_json.name.replace('_pages.json', '')
+		metadata = {'data_uscita': day_ymd}
+	elif issue:
+		identifier, metadata = issue
+	else:
+		identifier = getDayId(day, headboard)
+		print("INFO: Found {} for {}".format(identifier, day.strftime('%Y-%m-%d')))
+		metadata = getIssueMetadata(identifier)
+		sleep(0.1)
 	if not metadata:
 		# Sometimes the response is simply an empty page, for instance:
 		# INFO: Found 1066_01_1980_0230_0002 for 1980-10-20
@@ -105,48 +580,177 @@ def downloadDay(day, headboard='01'):
 		# Just keep going. TODO: Some logging?
 		metadata = {'data_uscita': day_ymd}
 
-	if not makeDay(day, metadata):
+	if resuming:
+		print("INFO: Resuming day {}".format(day_ymd))
+	elif not makeDay(day, metadata):
 		# We got a different day, probably there's a gap for festivities.
 		return None
 
-	# Prepare a session for this issue
-	# TODO: Add a timeout here or to requests.
-	s = requests.Session()
-	# We need the parameter from the hidden input
-	# <input type="hidden" name="t" value="a2016dedff5843c652d2fdf4f87055cc" />
-	home = s.get('http://www.archiviolastampa.it/')
-	t = re.findall('<input type="hidden" name="t" value="([a-z0-9]+)"', home.text)[0]
-	sleep(0.1)
-
-	# List pages in the issue
-	pages = s.get('http://www.archiviolastampa.it/load.php?url=/item/getPagesInfo.do?id={}&s={}'.format(identifier, t))
-	with open('{}/{}_pages.json'.format(day_ymd, identifier), 'w') as pages_out:
-		pages_out.write(pages.text)
-	sleep(0.1)
-
-	for page in pages.json()['pageList']:
-		page_id = page['thumbnailId']
-		page_image = s.get('http://www.archiviolastampa.it/load.php?url=/downloadContent.do?id={}_19344595&s={}'.format(page_id, t))
-		# TODO: might want to handle connection errors
-		# HTTPConnectionPool(host='www.archiviolastampa.it', port=80): Max retries exceeded with url: ... (Caused by NewConnectionError('<requests.packages.urllib3.connection.HTTPConnection object at 0x7f8a235d1c88>: Failed to establish a new connection: [Errno 110] Connection timed out',))
-		sleep(1.0)
-		if not 'image/jpeg' in page_image.headers['Content-Type']:
-			print("WARNING: could not download an image for {}".format(page_id))
-			incomplete = True
-			sleep(30)
-			continue
-		with open('{}/{}.jpg'.format(day_ymd, page_id), 'wb') as page_out:
-			page_out.write(page_image.content)
-
-		page_data = s.get('http://www.archiviolastampa.it/load.php?url=/search/select/?wt=json&q=pageID:{}&s={}&s={}'.format(page_id, t, t))
-		with open('{}/{}_pagedata.json'.format(day_ymd, page_id), 'w') as page_meta:
-			page_meta.write(page_data.text)
+	# List pages in the issue, unless we already have the list
+	pagelist = None
+	if pages_json:
+		try:
+			with open(pages_json, 'r') as j:
+				pagelist = json.load(j)['pageList']
+		except (json.decoder.JSONDecodeError, KeyError):
+			pagelist = None
+	if pagelist is None:
+		pagelist = getPageList(day_ymd, identifier)
 		sleep(0.1)
 
+	pacer = Pacer()
+	writer = PageWriter(day_ymd, identifier, archive)
+	try:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+			downloads = [executor.submit(downloadPage, writer, page['thumbnailId'], pacer) for page in pagelist]
+			incomplete = not all(download.result() for download in downloads)
+	finally:
+		writer.close()
+
 	if incomplete:
 		return False
+	writer.finish()
 	return True
 
+def getPageList(day_ymd, identifier):
+	""" Download the list of pages of the issue into the day directory and return it, with a new token if needed """
+
+	for attempt in range(2):
+		t = CLIENT.token()
+		pages = CLIENT.get('http://www.archiviolastampa.it/load.php?url=/item/getPagesInfo.do?id={}&s={}'.format(identifier, t), 'pages')
+		try:
+			pagelist = pages.json()['pageList']
+			break
+		except (ValueError, KeyError):
+			if attempt:
+				raise
+			CLIENT.reject(t)
+	with open('{}/{}_pages.json'.format(day_ymd, identifier), 'w') as pages_out:
+		pages_out.write(pages.text)
+	return pagelist
+
+def downloadPage(writer, page_id, pacer):
+	""" Download the image and the data of a page with the shared client, return False on failure """
+
+	fetched = False
+	if not writer.complete('{}.jpg'.format(page_id)):
+		fetched = True
+		for attempt in range(2):
+			t = CLIENT.token()
+			pacer.wait()
+			try:
+				page_image = CLIENT.get('http://www.archiviolastampa.it/load.php?url=/downloadContent.do?id={}_19344595&s={}'.format(page_id, t), 'image')
+			except requests.exceptions.RequestException as e:
+				# HTTPConnectionPool(host='www.archiviolastampa.it', port=80): Max retries exceeded with url: ... (Caused by NewConnectionError('<requests.packages.urllib3.connection.HTTPConnection object at 0x7f8a235d1c88>: Failed to establish a new connection: [Errno 110] Connection timed out',))
+				print("WARNING: could not download an image for {}: {}".format(page_id, e))
+				pacer.failure()
+				return False
+			if 'image/jpeg' in page_image.headers.get('Content-Type', ''):
+				break
+			METRICS.error('not an image')
+			if attempt:
+				print("WARNING: could not download an image for {}".format(page_id))
+				pacer.failure()
+				return False
+			# The token may have expired: try again with a new one
+			CLIENT.reject(t)
+		pacer.success()
+		writer.write('{}.jpg'.format(page_id), page_image.content)
+
+	if not writer.complete('{}_pagedata.json'.format(page_id)):
+		fetched = True
+		t = CLIENT.token()
+		pacer.wait()
+		try:
+			page_data = CLIENT.get('http://www.archiviolastampa.it/load.php?url=/search/select/?wt=json&q=pageID:{}&s={}&s={}'.format(page_id, t, t), 'pagedata')
+		except requests.exceptions.RequestException as e:
+			print("WARNING: could not download the data for {}: {}".format(page_id, e))
+			pacer.failure()
+			return False
+		writer.write('{}_pagedata.json'.format(page_id), page_data.text)
+	if fetched:
+		METRICS.count('pages')
+	return True
+
+def downloadDays(days, headboard='01', workers=1, retries=3, archive=False, issues=None, resume=False):
+	"""
+	Download several days at once, all under the global request budget.
+	Failed days are retried with exponential backoff, up to retries times,
+	and only then written to retry.log. With issues from readIssueIndex,
+	only the days with an issue are downloaded and no lookup is needed.
+	With resume, the existing days are completed instead of skipped, and
+	the failed days are retried from what they already have.
+	"""
+
+	if issues is not None:
+		days = [day for day in days if day.strftime('%Y-%m-%d') in issues]
+
+	fresh = collections.deque(days)
+	# Heap of (time after which to retry, attempt, day)
+	delayed = []
+	running = {}
+	with open('retry.log', 'a') as retry, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		while fresh or delayed or running:
+			while len(running) < workers:
+				if delayed and delayed[0][0] <= monotonic():
+					_, attempt, day = heapq.heappop(delayed)
+					if not resume:
+						# Start the day again from scratch
+						shutil.rmtree(day.strftime('%Y-%m-%d'), ignore_errors=True)
+				elif fresh:
+					day = fresh.popleft()
+					attempt = 0
+					# Without a manifest, the day predates the resumable downloads
+					if os.path.isdir(day.strftime('%Y-%m-%d')) and not (resume and os.path.exists(day.strftime('%Y-%m-%d/manifest.json'))
+							and not readManifest(day.strftime('%Y-%m-%d'))['complete']):
+						print("INFO: Day {} was already done".format(day.strftime('%Y-%m-%d')))
+						continue
+				else:
+					break
+				issue = issues.get(day.strftime('%Y-%m-%d')) if issues else None
+				running[executor.submit(downloadDay, day, headboard, archive, issue, resume)] = (day, attempt)
+
+			timeout = max(0, delayed[0][0] - monotonic()) if delayed else None
+			if not running:
+				if timeout is not None:
+					sleep(timeout)
+				continue
+			done, _ = concurrent.futures.wait(running, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				day, attempt = running.pop(future)
+				try:
+					download = future.result()
+				except Exception as e:
+					print(e)
+					download = False
+				if download:
+					METRICS.count('days')
+				elif download is False:
+					METRICS.error('failed day')
+				if download is None:
+					print("INFO: Nothing to do for {}".format(day))
+				elif download is False and attempt < retries:
+					backoff = 30 * 2 ** attempt
+					print("ERROR: Something went wrong with {}, retrying in {} seconds.".format(day, backoff))
+					heapq.heappush(delayed, (monotonic() + backoff, attempt + 1, day))
+				elif download is False:
+					print("ERROR: Something went wrong with {}, please retry.".format(day))
+					retry.write("{}\n".format(day))
+					retry.flush()
+
+def parseOptions(argv):
+	""" Split the command line into positional arguments and a dictionary of --key=value options """
+
+	options = {}
+	positional = []
+	for arg in argv:
+		if arg.startswith('--'):
+			key, _, value = arg[2:].partition('=')
+			options[key] = value or True
+		else:
+			positional.append(arg)
+	return positional, options
+
 def listDates(start='1867-02-09', end='2005-12-31'):
 	""" Return list of days between two dates """
 
@@ -162,8 +766,12 @@ def getDayCounts(day):
 	identifier = ''
 	for dayfile in Path(day).iterdir():
 		if dayfile.name.endswith('_images.zip'):
-			arc = zipfile.ZipFile(day + '/' + dayfile.name)
-			imagecount = len([image.filename for image in arc.infolist() if image.filename.endswith('jpg')])
+			# Only the central directory is read
+			try:
+				with zipfile.ZipFile(day + '/' + dayfile.name) as arc:
+					imagecount = len([image.filename for image in arc.infolist() if image.filename.endswith('jpg')])
+			except zipfile.BadZipFile:
+				print("WARNING: Could not open the images archive for day {}".format(day))
 		if dayfile.name.endswith('_pages.json'):
 			identifier = dayfile.name.replace('_pages.json', '')
 			with open(day + '/' + dayfile.name, 'r') as j:
@@ -175,25 +783,60 @@ def getDayCounts(day):
 					pass
 	return imagecount, pagecount, identifier
 
-def verifyDirectory():
-	""" Verify the contents of the archives of the current directory """
+def getDaySignature(day):
+	""" Return modification time and total size of the files of a day directory, which change when its contents do """
+
+	size = 0
+	mtime = os.stat(day).st_mtime_ns
+	for entry in os.scandir(day):
+		stat = entry.stat()
+		size += stat.st_size
+		mtime = max(mtime, stat.st_mtime_ns)
+	return [mtime, size]
+
+def verifyDirectory(cache='issue-counts.cache.json'):
+	"""
+	Verify the contents of the archives of the current directory.
+	The counts are computed in parallel and cached by directory signature,
+	so that the next verifications only need to look at the changed days.
+	"""
 
 	complete = True
-	csvout = open('issue-counts.csv', 'w')
-	writer = csv.writer(csvout,
-			delimiter='\t',
-			lineterminator='\n',
-			quoting=csv.QUOTE_MINIMAL,
-			)
-	writer.writerow(['Date', 'Image count', 'Page count', 'Identifier'])
-
-	days = set([d.name for d in Path('.').iterdir() if re.match('[0-9-]{10}', d.name)])
-	for day in days:
-		imagecount, pagecount, identifier = getDayCounts(day)
-		if imagecount > 0 and pagecount > 0 and imagecount != pagecount:
-			print("ERROR: Day {} has {} images for {} expected pages".format(day, imagecount, pagecount))
-			complete = False
-		writer.writerow([day, imagecount, pagecount, identifier])
+	counts = {}
+	if os.path.exists(cache):
+		with open(cache, 'r') as j:
+			try:
+				counts = json.load(j)
+			except json.decoder.JSONDecodeError:
+				print("WARNING: Could not read the cache {}, starting over".format(cache))
+
+	days = sorted([d.name for d in Path('.').iterdir() if re.match('[0-9-]{10}', d.name)])
+	signatures = {day: getDaySignature(day) for day in days}
+	changed = [day for day in days if day not in counts or counts[day][0] != signatures[day]]
+	print("INFO: Counting {} new or changed days out of {}".format(len(changed), len(days)))
+	with concurrent.futures.ProcessPoolExecutor() as executor:
+		for day, daycounts in zip(changed, executor.map(getDayCounts, changed, chunksize=16)):
+			counts[day] = [signatures[day]] + list(daycounts)
+			METRICS.count('days')
+	counts = {day: counts[day] for day in days}
+
+	with open(cache + '.tmp', 'w') as j:
+		json.dump(counts, j)
+	os.replace(cache + '.tmp', cache)
+
+	with open('issue-counts.csv', 'w') as csvout:
+		writer = csv.writer(csvout,
+				delimiter='\t',
+				lineterminator='\n',
+				quoting=csv.QUOTE_MINIMAL,
+				)
+		writer.writerow(['Date', 'Image count', 'Page count', 'Identifier'])
+		for day in days:
+			_, imagecount, pagecount, identifier = counts[day]
+			if imagecount > 0 and pagecount > 0 and imagecount != pagecount:
+				print("ERROR: Day {} has {} images for {} expected pages".format(day, imagecount, pagecount))
+				complete = False
+			writer.writerow([day, imagecount, pagecount, identifier])
 
 	return complete
 
@@ -227,8 +870,27 @@ La licenza Creative Commons non ha ad oggetto le singole foto ed i singoli artic
 
 	return metadata
 
-def uploadDay(day):
-	""" Upload the archives in the directory for this day to the Internet Archive """
+def getUploadedItems():
+	""" Return a dictionary of identifier: item_size of the La Stampa items already on the Internet Archive """
+
+	uploaded = {}
+	for item in search_items('identifier:lastampa_* OR identifier:stampa-sera_*', fields=['identifier', 'item_size']):
+		uploaded[item['identifier']] = int(item.get('item_size') or 0)
+	return uploaded
+
+def isSlowDown(error):
+	""" Whether an upload error is the Internet Archive asking to slow down """
+
+	message = str(error)
+	return 'total_tasks_queued exceeds global_limit' in message or 'reduce your request rate' in message or 'SlowDown' in message
+
+def uploadDay(day, uploaded=None):
+	"""
+	Upload the archives in the directory for this day to the Internet Archive.
+	Items are checked with uploaded from getUploadedItems if given.
+	Return True on success, False on failure and None if the Internet Archive
+	asked to slow down, so that the day can be tried again later.
+	"""
 
 	try:
 		imagecount, pagecount, stampaid = getDayCounts(day)
@@ -252,25 +914,152 @@ def uploadDay(day):
 		identifier = "lastampa_{}".format(day)
 
 	try:
-		item = get_item(identifier)
-		if item and item.item_size and item.item_size > 5000000:
-			print("INFO: Day {} was already uploaded at {}, size {}. Skipping.".format(day, identifier, item.item_size))
+		if uploaded is not None:
+			item_size = uploaded.get(identifier, 0)
+		else:
+			item = get_item(identifier)
+			item_size = item.item_size if item else 0
+		if item_size and item_size > 5000000:
+			print("INFO: Day {} was already uploaded at {}, size {}. Skipping.".format(day, identifier, item_size))
 			return True
 
-		iafiles = [day + '/' + arc.name for arc in Path(day).iterdir()]
+		iafiles = [day + '/' + arc.name for arc in Path(day).iterdir() if arc.name != 'manifest.json']
 		print("INFO: Uploading day {} with {} files".format(day, len(iafiles)))
-		r = upload(identifier, files=iafiles, metadata=md, retries=5, retries_sleep=300)
+		token = METRICS.start('upload {}'.format(day))
+		try:
+			r = upload(identifier, files=iafiles, metadata=md, retries=5, retries_sleep=300)
+		except Exception as e:
+			METRICS.finish(token, error=type(e).__name__)
+			raise
+		METRICS.finish(token, sum(os.path.getsize(iafile) for iafile in iafiles), None if r[0].status_code < 400 else 'HTTP {}'.format(r[0].status_code))
 		sleep(5)
 		if r[0].status_code < 400:
 			return True
+		if r[0].status_code == 503 or isSlowDown(r[0].text):
+			return None
+		return False
 	# FIXME: Specifically handle the various failures, like:
 	# ResponseError('too many 502 error responses')
-	# Please reduce your request rate. - total_tasks_queued exceeds global_limit
 	except Exception as e:
+		if isSlowDown(e):
+			print("WARNING: Upload of day {} postponed, the Internet Archive asks to slow down".format(day))
+			return None
 		print("ERROR: Upload failed for day {}".format(day))
 		print(e)
 		return False
 
+def isOverloaded():
+	""" Whether the Internet Archive S3 API reports that its task queue is overloaded """
+
+	try:
+		return get_session().s3_is_overloaded()
+	except Exception as e:
+		print("WARNING: Could not check the Internet Archive load: {}".format(e))
+		return False
+
+def uploadDays(days, max_workers=4):
+	"""
+	Upload the days, skipping the items found by one search at the start.
+	Concurrency starts at 2 and is widened after a series of successes,
+	narrowed when the Internet Archive is overloaded or asks to slow down;
+	the postponed days are tried again later.
+	"""
+
+	uploaded = getUploadedItems()
+	print("INFO: Found {} items already uploaded".format(len(uploaded)))
+	pending = collections.deque(days)
+	running = {}
+	postponed = collections.Counter()
+	limit = 2
+	successes = 0
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+		while pending or running:
+			if pending and len(running) < limit:
+				if isOverloaded():
+					limit = max(1, limit - 1)
+					print("INFO: The Internet Archive is overloaded, uploading {} days at a time".format(limit))
+					if not running:
+						sleep(60)
+				else:
+					while pending and len(running) < limit:
+						day = pending.popleft()
+						running[executor.submit(uploadDay, day, uploaded)] = day
+			if not running:
+				continue
+			done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				day = running.pop(future)
+				result = future.result()
+				if result is None:
+					postponed[day] += 1
+					successes = 0
+					limit = max(1, limit // 2)
+					if postponed[day] <= 10:
+						print("INFO: Will retry day {} later, uploading {} days at a time".format(day, limit))
+						pending.append(day)
+					else:
+						print("ERROR: Giving up on day {} after {} slow downs".format(day, postponed[day] - 1))
+					sleep(min(600, 60 * postponed[day]))
+				elif result:
+					METRICS.count('days')
+					successes += 1
+					if successes >= 5 and limit < max_workers:
+						limit += 1
+						successes = 0
+						print("INFO: Uploading {} days at a time".format(limit))
+
+# The Italian stopwords, loaded from nltk on first use
+STOPWORDS = None
+
+# How many distinct n-grams to count before the rarest are pruned
+GRAM_CAPACITY = 500000
+
+def getStopwords():
+	""" Return the Italian stopwords as a set, loading them only once """
+	global STOPWORDS
+
+	if STOPWORDS is None:
+		STOPWORDS = frozenset(nltk.corpus.stopwords.words("italian"))
+	return STOPWORDS
+
+def iterTokens(lines):
+	""" Yield the lowercase words of the lines of an OCR text, without the stopwords """
+
+	stopwords = getStopwords()
+	for line in lines:
+		for word in nltk.tokenize.word_tokenize(line, language="italian"):
+			if word.isalnum():
+				word = word.lower()
+				if word not in stopwords:
+					yield word
+
+def countGrams(tokens, min_len=2, max_len=5, capacity=GRAM_CAPACITY):
+	"""
+	Count the n-grams from min_len to max_len words in the tokens with a
+	sliding window. When more than capacity n-grams are counted, the rarest
+	are dropped until half are left: the frequent ones survive the pruning.
+	"""
+
+	counts = collections.Counter()
+	window = collections.deque(maxlen=max_len)
+	for token in tokens:
+		window.append(token)
+		gram = tuple(window)
+		for start in range(0, len(gram) - min_len + 1):
+			counts[gram[start:]] += 1
+		if len(counts) > capacity:
+			threshold = 1
+			while len(counts) > capacity // 2:
+				counts = collections.Counter({gram: count for gram, count in counts.items() if count > threshold})
+				threshold += 1
+	return counts
+
+def getSubjects(lines, limit=50, mincount=3):
+	""" Return the limit most frequent n-grams found more than mincount times in the lines """
+
+	counts = countGrams(iterTokens(lines))
+	return [" ".join(gram) for gram, count in counts.most_common(limit) if count > mincount]
+
 def getDaySubjects(identifier):
 	""" Attempt to add subjects based on the 50 most frequent n-grams in this IA item """
 
@@ -278,66 +1067,236 @@ def getDaySubjects(identifier):
 	# https://agailloty.rbind.io/en/project/nlp_clean-text/
 	# https://stackoverflow.com/a/58656665
 	# print("INFO: Planning to add the following words to {}".format(identifier))
-	r = requests.get("https://archive.org/download/{}/{}_djvu.txt".format(identifier, identifier))
-	tokens = nltk.tokenize.word_tokenize(r.text, language="italian")
-	tokens = [word.lower() for word in tokens if word.isalnum() and not word in nltk.corpus.stopwords.words("italian")]
+	r = requests.get("https://archive.org/download/{}/{}_djvu.txt".format(identifier, identifier), stream=True, timeout=60)
+	r.encoding = r.encoding or 'utf-8'
+	return getSubjects(r.iter_lines(decode_unicode=True))
+
+def getSubjectsNaive(text):
+	""" The original extractor, with all the n-grams of the text in memory, for comparison """
+
+	tokens = nltk.tokenize.word_tokenize(text, language="italian")
+	tokens = [word.lower() for word in tokens if word.isalnum() and not word.lower() in nltk.corpus.stopwords.words("italian")]
 	grams = nltk.FreqDist(nltk.everygrams(tokens, min_len=2, max_len=5))
-	commongrams = [ " ".join(gram[0]) for gram in grams.most_common() if gram[1] > 3][:50]
-	return commongrams
+	return [ " ".join(gram[0]) for gram in grams.most_common() if gram[1] > 3][:50]
+
+def benchmarkSubjects(path):
+	""" Compare time and peak memory of the naive and streaming extractors on a local _djvu.txt file """
+	import tracemalloc
+
+	results = {}
+	for name in ("naive", "streaming"):
+		tracemalloc.start()
+		start = monotonic()
+		with open(path, encoding='utf-8') as text:
+			if name == "naive":
+				results[name] = getSubjectsNaive(text.read())
+			else:
+				results[name] = getSubjects(text)
+		elapsed = monotonic() - start
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+		print("INFO: {} extractor took {:.2f} s with a peak of {:.1f} MiB".format(name, elapsed, peak / 2**20))
+	common = set(results["naive"]) & set(results["streaming"])
+	print("INFO: {} of the {} naive subjects were also found by the streaming extractor".format(len(common), len(results["naive"])))
+
+# How many of the most frequent n-grams of each item are kept for the corpus statistics
+GRAMS_PER_ITEM = 500
+
+class SubjectStore:
+	"""
+	SQLite store of the most frequent n-grams of each item (docs) and of the
+	number of items each n-gram is found in (df), updated one item at a time,
+	to score the n-grams of an item by TF-IDF against the whole corpus.
+	"""
+
+	def __init__(self, path='subjects.sqlite'):
+		self.connection = sqlite3.connect(path)
+		self.connection.execute('PRAGMA journal_mode=WAL')
+		self.connection.execute("CREATE TABLE IF NOT EXISTS docs (identifier TEXT PRIMARY KEY, grams TEXT NOT NULL)")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS df (gram TEXT PRIMARY KEY, n INTEGER NOT NULL)")
+
+	def __contains__(self, identifier):
+		return self.connection.execute("SELECT 1 FROM docs WHERE identifier = ?", (identifier,)).fetchone() is not None
+
+	def __len__(self):
+		return self.connection.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+	def add(self, identifier, grams):
+		""" Record the list of (gram, count) of an item, unless it was already added """
+		with self.connection:
+			if identifier in self:
+				return
+			self.connection.execute("INSERT INTO docs VALUES (?, ?)", (identifier, json.dumps(grams)))
+			self.connection.executemany("INSERT INTO df VALUES (?, 1) ON CONFLICT(gram) DO UPDATE SET n = n + 1",
+				[(gram,) for gram, count in grams])
+
+	def grams(self, identifier):
+		""" Return the list of (gram, count) recorded for an item, or None """
+		row = self.connection.execute("SELECT grams FROM docs WHERE identifier = ?", (identifier,)).fetchone()
+		return json.loads(row[0]) if row else None
+
+	def score(self, grams, limit=50, mincount=3):
+		""" Return the limit n-grams with the highest TF-IDF among the list of (gram, count) """
+		total = len(self) + 1
+		scores = []
+		for gram, count in grams:
+			if count <= mincount:
+				continue
+			row = self.connection.execute("SELECT n FROM df WHERE gram = ?", (gram,)).fetchone()
+			scores.append((count * log(total / ((row[0] if row else 0) + 1)), gram))
+		return [gram for score, gram in sorted(scores, reverse=True)[:limit]]
+
+	def frequent(self, limit=100):
+		""" Return the limit n-grams found in the most items """
+		return [row[0] for row in self.connection.execute("SELECT gram FROM df ORDER BY n DESC LIMIT ?", (limit,))]
+
+	def close(self):
+		self.connection.close()
+
+def fetchDayText(identifier, cache='djvu-cache'):
+	""" Download the OCR text of an IA item into the compressed cache, unless there already, and return its path """
+
+	path = Path(cache) / "{}_djvu.txt.gz".format(identifier)
+	if path.exists():
+		return path
+	path.parent.mkdir(parents=True, exist_ok=True)
+	partial = path.with_suffix('.part')
+	try:
+		with requests.get("https://archive.org/download/{}/{}_djvu.txt".format(identifier, identifier), stream=True, timeout=60) as r:
+			r.raise_for_status()
+			with gzip.open(partial, 'wb') as text:
+				for chunk in r.iter_content(chunk_size=65536):
+					text.write(chunk)
+	except (requests.exceptions.RequestException, OSError) as e:
+		print("WARNING: Could not download the text of {}: {}".format(identifier, e))
+		return None
+	os.replace(partial, path)
+	return path
+
+def getCachedGrams(path, limit=GRAMS_PER_ITEM):
+	""" Return the limit most frequent (gram, count) of a cached OCR text """
 
-def getDaySubjectsAll(query):
-	""" Attempt to add subjects based on the most frequent n-grams in the items returned by the query """
-	subjects = {}
-	allsubjects = []
+	with gzip.open(path, 'rt', encoding='utf-8', errors='replace') as text:
+		counts = countGrams(iterTokens(text))
+	return [(" ".join(gram), count) for gram, count in counts.most_common(limit)]
+
+def getDaySubjectsAll(query, cache='djvu-cache', store='subjects.sqlite'):
+	"""
+	Attempt to add subjects based on the most frequent n-grams in the items returned by the query.
+	The texts are downloaded by threads into the cache and tokenized by processes,
+	then the n-grams of each item are added to the store; the items already in
+	the store are not downloaded nor tokenized again.
+	"""
 
+	store = SubjectStore(store)
 	identifiers = [item['identifier'] for item in search_items(query)]
-	with concurrent.futures.ProcessPoolExecutor() as executor:
-		for item, itemsubjects in zip(identifiers, executor.map(getDaySubjects, identifiers)):
-			subjects[item] = itemsubjects
-	for key, value in subjects.items():
-		allsubjects += value
-	frequentsubjects = [subject[0] for subject in collections.Counter(allsubjects).most_common(100)]
+	identifiers = [identifier for identifier in identifiers if identifier not in store]
+	print("INFO: Adding {} items to the {} already known".format(len(identifiers), len(store)))
+	with concurrent.futures.ThreadPoolExecutor(max_workers=8) as fetcher, concurrent.futures.ProcessPoolExecutor() as tokenizer:
+		fetches = {fetcher.submit(fetchDayText, identifier, cache): identifier for identifier in identifiers}
+		tokenizations = {}
+		for future in concurrent.futures.as_completed(fetches):
+			path = future.result()
+			if path:
+				tokenizations[tokenizer.submit(getCachedGrams, path)] = fetches[future]
+		for future in concurrent.futures.as_completed(tokenizations):
+			try:
+				store.add(tokenizations[future], future.result())
+			except Exception as e:
+				print("WARNING: Could not tokenize {}: {}".format(tokenizations[future], e))
+	frequentsubjects = store.frequent(100)
 	print("INFO: Would discard the following frequent subjects: {}".format("; ".join(frequentsubjects)))
+	store.close()
+
+def getDaySubjectsScored(identifier, cache='djvu-cache', store='subjects.sqlite'):
+	""" Attempt to add subjects based on the 50 n-grams of this IA item with the highest TF-IDF in the store """
+
+	store = SubjectStore(store)
+	grams = store.grams(identifier)
+	if grams is None:
+		path = fetchDayText(identifier, cache)
+		if not path:
+			store.close()
+			return []
+		grams = getCachedGrams(path)
+	subjects = store.score(grams)
+	store.close()
+	return subjects
+
+def startReporter(options):
+	""" Start reporting the metrics as set by the --status=SECONDS, --metrics=FILE and --watchdog=MINUTES options """
+
+	path = options.get('metrics')
+	if path is True:
+		path = 'metrics.json'
+	watchdog = options.get('watchdog')
+	reporter = Reporter(METRICS, interval=float(options.get('status', 60)), path=path, watchdog=float(watchdog) if watchdog else None)
+	reporter.start()
+	return reporter
 
 def main(argv=None):
 	# TODO: Hacky commandline arguments are hacky!
+	global BUDGET
+	argv, options = parseOptions(argv)
 	if argv[1] == "verify":
-		return verifyDirectory()
+		reporter = startReporter(options)
+		try:
+			return verifyDirectory()
+		finally:
+			reporter.stop()
 
 	if argv[1] == "upload":
 		days = set([d.name for d in Path('.').iterdir() if re.match('[0-9-]{10}', d.name)])
-		with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
-			for upload in executor.map(uploadDay, sorted(list(days))):
-				pass
-		return
+		reporter = startReporter(options)
+		try:
+			return uploadDays(sorted(list(days)), max_workers=int(options.get('workers', 4)))
+		finally:
+			reporter.stop()
+
+	# With --store[=FILE] the subjects are scored by TF-IDF against the
+	# items added by the allsubjects mode.
+	store = options.get('store')
+	if store is True:
+		store = 'subjects.sqlite'
 
 	if argv[1] == "allsubjects":
-		return getDaySubjectsAll(argv[2])
+		return getDaySubjectsAll(argv[2], store=store or 'subjects.sqlite')
 
 	if argv[1] == "subjects":
+		if store:
+			return getDaySubjectsScored(argv[2], store=store)
 		return getDaySubjects(argv[2])
 
-	retry = open('retry.log', 'a')
-	for day in listDates(argv[2], argv[3]):
-		day_ymd = day.strftime('%Y-%m-%d')
-		if os.path.isdir(day_ymd):
-			print("INFO: Day {} was already done".format(day_ymd))
-			continue
-		try:
-			download = downloadDay(day, headboard=argv[1])
-			# TODO: Also take care of compression and verification
-			sleep(2)
-		except Exception as e:
-			print(e)
-			download = False
-		if download is None:
-			print("INFO: Nothing to do for {}".format(day))
-			continue
-		if download is False:
-			print("ERROR: Something went wrong with {}, please retry. Sleeping now.".format(day))
-			retry.write("{}\n".format(day))
-			sleep(30)
-			
-	retry.close()
+	if argv[1] == "subjectsbench":
+		return benchmarkSubjects(argv[2])
+
+	index = options.get('index')
+	if index is True:
+		index = None
+
+	if argv[1] == "index":
+		# Index mode: headboard, optionally first and last day
+		BUDGET = RateBudget(float(options.get('rate', 2.0)))
+		return buildIssueIndex(argv[2], *argv[3:5], path=index)
+
+	# Download mode: headboard, first and last day, optionally with
+	# --days=N days downloaded at once and --rate=R requests per second.
+	# With --zip the pages go straight into the archives for the upload.
+	# With --index[=FILE] only the issues listed by the index mode are
+	# downloaded. With --resume the days already started are completed.
+	# In all of verify, upload and download mode a status line is printed
+	# every --status=SECONDS, the metrics are saved to --metrics=FILE (as
+	# Prometheus text if it ends with .prom) and --watchdog=MINUTES flags
+	# the lack of progress.
+	BUDGET = RateBudget(float(options.get('rate', 2.0)))
+	issues = None
+	if 'index' in options:
+		issues = readIssueIndex(index or 'issues-{}.tsv'.format(argv[1]))
+	reporter = startReporter(options)
+	try:
+		downloadDays(listDates(argv[2], argv[3]), headboard=argv[1], workers=int(options.get('days', 1)), retries=int(options.get('retries', 3)), archive='zip' in options, issues=issues, resume='resume' in options)
+	finally:
+		reporter.stop()
+
 if __name__ == "__main__":
 	main(sys.argv)